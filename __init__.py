@@ -77,6 +77,12 @@ SN比の計算
 
 以上をpandas DataFrame形式(表形式)で返す
 
+freqにリストを渡すと、全周波数の窓を1回のsearchsortedで探して
+行が(周波数, 列)のDataFrameで返す
+
+    usage:
+        `describe_SN(df, [120, 150, 180])`
+
 # lcbin.py
 Binary Capacitance table
 インダクタンス容量からコンデンサのバイナリ
@@ -112,9 +118,22 @@ Binary Capacitance table
 
 from .csv_reader import reader_N5071
 from .csv_reader import reader_N9010A
+from .csv_reader import iter_rows
 from .describe_SN import describe_SN
+from .sketch import QuantileSketch
+from .sketch import streaming_noisefloor
+from .sketch import streaming_describe_SN
 from .sana import Syncf
 from .sana import nearest_x
+from .sana import crossings
+from .sana import describe_many
+from .sana import fit_lorentzian
 from .dbmw import db2mw
 from .dbmw import mw2db
+from .dbmw import noisefloor
+from .dbmw import RollingNoiseFloor
 from .lcbin import Lcbin
+from .lcbin import VirtualLcbin
+from .lcbin import sweep
+from .designer import design_bank
+from .tracestore import TraceStore
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""csv_readerで読んだtraceのディスクキャッシュ
+
+同じCSVを何度も読み直すときに、テキストをパースする代わりに
+.npyをメモリマップで読む。
+キーはファイルのパス, サイズ, 更新時刻とreaderのパラメータなので、
+ファイルが変わればキャッシュは使われない。
+合計サイズがmax_bytesを超えたら、最後に使ったのが古いものから消す(LRU)。
+
+usage:
+    `reader_N9010A('data/*.csv')`  # デフォルトのキャッシュを使う
+    `cache.disable()`  # キャッシュを使わない
+    `cache.enable('/tmp/sana', max_bytes=2**30)`  # 場所と上限を変える
+    `cache.clear()`  # キャッシュを消す
+"""
+import hashlib
+import json
+import os
+import warnings
+import numpy as np
+import pandas as pd
+
+VERSION = 1
+
+
+def default_directory() -> str:
+    """キャッシュの場所
+    環境変数SANA_CACHE_DIR > XDG_CACHE_HOME/sana > ~/.cache/sana"""
+    if os.environ.get('SANA_CACHE_DIR'):
+        return os.environ['SANA_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'sana')
+
+
+class TraceCache:
+    """traceを(周波数.npy, 値.npy, メタデータ.json)で保存するキャッシュ
+
+    args:
+        directory: 保存先(デフォルトdefault_directory())
+        max_bytes: 合計サイズの上限(デフォルト1GiB)
+        enabled: Falseならget()は常にNone, put()は何もしない
+            directoryを作れなければput()がFalseにする
+
+    >>> c = TraceCache('/dev/null/sana')
+    >>> with warnings.catch_warnings(record=True):
+    ...     c.put(__file__, {}, pd.Series([1.]), {})
+    >>> c.enabled
+    False
+    """
+
+    def __init__(self,
+                 directory: str = None,
+                 max_bytes: int = 2**30,
+                 enabled: bool = True):
+        self.directory = directory or default_directory()
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        # 合計サイズの見積もり(Noneなら次のput()で数え直す)
+        self._total = None
+
+    def __repr__(self):
+        return 'TraceCache(directory={!r}, max_bytes={}, enabled={})'.format(
+            self.directory, self.max_bytes, self.enabled)
+
+    def key(self, path, params: dict) -> str:
+        """パス, サイズ, 更新時刻, paramsから作るキー"""
+        stat = os.stat(path)
+        source = json.dumps([
+            VERSION,
+            os.path.abspath(path), stat.st_size, stat.st_mtime_ns, params
+        ], sort_keys=True, default=str)
+        return hashlib.sha1(source.encode()).hexdigest()
+
+    def _paths(self, key: str):
+        base = os.path.join(self.directory, key)
+        return base + '.x.npy', base + '.y.npy', base + '.json'
+
+    def get(self, path, params: dict):
+        """キャッシュがあれば(trace, meta)を返す(なければNone)
+        traceの周波数と値はメモリマップ"""
+        if not self.enabled:
+            return None
+        x_path, y_path, meta_path = self._paths(self.key(path, params))
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            x = np.load(x_path, mmap_mode='r')
+            y = np.load(y_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        # 最後に使った時刻(LRU) 読み込み専用のキャッシュなら更新しない
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+        return pd.Series(y, index=pd.Index(x), copy=False), meta
+
+    def put(self, path, params: dict, trace, meta: dict):
+        """(trace, meta)を保存して、上限を超えたら古いものを消す
+        書き込めないときは警告だけ出す
+        directoryを作れないときは警告を出して、以後キャッシュを使わない"""
+        if not self.enabled:
+            return
+        key = self.key(path, params)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as err:
+            warnings.warn('TraceCache: {}; caching disabled'.format(err))
+            self.enabled = False
+            return
+        try:
+            if self._total is None:
+                self._total = self.size()
+            for dst, value in zip(self._paths(key),
+                                  (trace.index.values, trace.values, meta)):
+                # 書きかけのファイルを読まないように、一時ファイルから置き換える
+                tmp = '{}.{}.tmp'.format(dst, os.getpid())
+                with open(tmp, 'wb' if dst.endswith('.npy') else 'w') as f:
+                    if dst.endswith('.npy'):
+                        np.save(f, np.asarray(value))
+                    else:
+                        json.dump(value, f)
+                self._total += os.path.getsize(tmp)
+                os.replace(tmp, dst)
+            # 見積もりが上限を超えたときだけディレクトリを数え直す
+            if self._total > self.max_bytes:
+                self.evict()
+        except OSError as err:
+            warnings.warn('TraceCache: {}'.format(err))
+
+    def entries(self) -> list:
+        """[(最後に使った時刻, サイズ, キー)]"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                used = os.stat(os.path.join(self.directory, name)).st_mtime
+                size = sum(os.stat(p).st_size for p in self._paths(key))
+            except FileNotFoundError:
+                continue
+            entries.append((used, size, key))
+        return entries
+
+    def size(self) -> int:
+        """キャッシュの合計サイズ[byte]"""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes: int = None):
+        """合計サイズがmax_bytes以下になるまで、最後に使ったのが古いものから消す"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= max_bytes:
+                break
+            self._remove(key)
+            total -= size
+        self._total = total
+
+    def clear(self):
+        """キャッシュをすべて消す"""
+        for _, _, key in self.entries():
+            self._remove(key)
+        self._total = 0
+
+    def _remove(self, key: str):
+        # jsonを先に消して、読みかけのキャッシュを無効にする
+        for path in reversed(self._paths(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# readerが使うデフォルトのキャッシュ
+_default = TraceCache(enabled=os.environ.get('SANA_CACHE', '1') != '0')
+
+
+def get_cache() -> TraceCache:
+    """readerが使うデフォルトのキャッシュ"""
+    return _default
+
+
+def enable(directory: str = None, max_bytes: int = None):
+    """デフォルトのキャッシュを使う(場所と上限も変えられる)"""
+    _default.enabled = True
+    if directory is not None:
+        _default.directory = directory
+        _default._total = None
+    if max_bytes is not None:
+        _default.max_bytes = max_bytes
+
+
+def disable():
+    """デフォルトのキャッシュを使わない"""
+    _default.enabled = False
+
+
+def clear():
+    """デフォルトのキャッシュを消す"""
+    _default.clear()
@@ -3,6 +3,8 @@
 """ 組み合わせ計算に使用する計算ライブラリ"""
 from itertools import combinations_with_replacement
 from itertools import chain
+from functools import lru_cache
+import numpy as np
 
 # E24系列
 CAPLIST_E24 = [
@@ -15,14 +17,23 @@ CAPLIST_E24 = [
 ]
 
 
-def combi_proposer(combo: int, var, caplist: list = CAPLIST_E24) -> tuple:
+def combi_proposer(combo: int,
+                   var,
+                   caplist: list = CAPLIST_E24,
+                   tol: float = None,
+                   rel_tol: float = None,
+                   top: int = None) -> tuple:
     """合計してvarになる組み合わせをリストする
     組み合わせパターンをcomboに指定する(2組の合計を出すなら、combo=2)
     caplistから重複ありの組み合わせをc_combinationsに格納
     合計してvarになる組み合わせcaplist要素の組み合わせをtuple in tupleで返す
 
+    tol, rel_tol, topのどれかを指定すると、合計が
+    var±max(tol, rel_tol*|var|)の組み合わせを誤差の小さい順に上位top個返す
+
     usage:
         combi_proposer(combo=2, var=22)  # 22を2個の合計で実現する組み合わせを列挙
+        combi_proposer(2, 470, rel_tol=0.02, top=10)  # 470pF±2%の上位10組
 
     test:
     >>> combi_proposer(2, 100)
@@ -47,21 +58,254 @@ def combi_proposer(combo: int, var, caplist: list = CAPLIST_E24) -> tuple:
     {22: ((10, 12), (11, 11)), 24: ((11, 13), (12, 12)),\
  26: ((10, 16), (11, 15), (13, 13))}
     """
+    index = combination_index(caplist, combo)
+    exact = tol is None and rel_tol is None and top is None
     if not isinstance(var, (list, tuple)):
-        # 重複組み合わせ
-        c_combinations = list(combinations_with_replacement(caplist, combo))
-        # 組み合わせ合計値
-        c_patterns = (sum(tpl) for tpl in c_combinations)
-        # c_combinationsの合計(=c_patterns)がvarとなるときのインデックス
-        ix_list = [i for i, c in enumerate(c_patterns) if c == var]
-        # 合計がvarになるときの組み合わせ
-        return tuple(c_combinations[i] for i in ix_list)
-    return {k: combi_proposer(combo, k, caplist) for k in var}
+        if exact:
+            # 合計がvarになるときの組み合わせ(caplistのインデックス)
+            ix = index.find(var)
+        else:
+            ix, _ = index.near(var, tol or 0, rel_tol or 0, top)
+        return _to_parts(ix, caplist)
+    if exact:
+        found = index.find_many(var)
+    else:
+        found = [index.near(k, tol or 0, rel_tol or 0, top)[0] for k in var]
+    return {k: _to_parts(ix, caplist) for k, ix in zip(var, found)}
+
+
+def combi_within(combo: int,
+                 lo: float,
+                 hi: float,
+                 caplist: list = CAPLIST_E24,
+                 top: int = None) -> tuple:
+    """合計がlo~hiになる組み合わせを、(lo + hi) / 2に近い順にリストする
+    topを指定すると上位top個だけ返す
+
+    >>> combi_within(2, 35, 38, [10, 12, 16, 18, 20, 24], top=3)
+    ((12, 24), (16, 20), (18, 18))
+    """
+    ix, _ = combination_index(caplist, combo).within(lo, hi, top)
+    return _to_parts(ix, caplist)
+
+
+def _to_parts(ix, caplist):
+    """インデックスの配列をcaplistの値のtuple in tupleにする"""
+    return tuple(tuple(caplist[i] for i in row) for row in ix.tolist())
+
+
+def subset_sum(combo: int, var, caplist: list = CAPLIST_E24) -> np.ndarray:
+    """caplistから重複ありでcombo個選んで合計がvarになる組み合わせの
+    インデックスを返す
+    `combination_index(caplist, combo).find(var)`と同じ
+
+    return: 組み合わせのインデックス(shape=(n, combo))
+        行の順番はcombinations_with_replacement()と同じ
+
+    >>> subset_sum(2, 36, [10, 12, 16, 18, 20, 24])
+    array([[1, 5],
+           [2, 4],
+           [3, 3]])
+    """
+    return combination_index(caplist, combo).find(var)
+
+
+def combination_index(caplist: list = CAPLIST_E24, combo: int = 2):
+    """(tuple(caplist), combo)ごとにキャッシュしたCombinationIndexを返す
+    キャッシュは最近使った16個まで"""
+    return _cached_index(tuple(caplist), combo)
+
+
+class CombinationIndex:
+    """caplistから重複ありでcombo個選んだ組み合わせの合計の索引
+
+    combinations_with_replacement()をすべて列挙する代わりに、
+    前半combo//2個と後半の組み合わせの合計をそれぞれ求め(半分全列挙)、
+    後半の合計をソートしておく。
+    検索はvar - 前半の合計を二分探索するだけなので、
+    一度作れば何度でも、複数のvarをまとめても引ける。
+    一致判定は`sum(tpl) == var`と同じく左から順に足した浮動小数点の値で行う
+
+    usage:
+        `index = CombinationIndex(CAPLIST_E24, 3)`
+        `index.find(470)`  # 合計470になる組み合わせのインデックス
+        `index.find_many([220, 470])`  # 複数のvarをまとめて検索
+
+    >>> index = CombinationIndex([10, 12, 16, 18, 20, 24], 2)
+    >>> index.find(36)
+    array([[1, 5],
+           [2, 4],
+           [3, 3]])
+    >>> [len(ix) for ix in index.find_many([20, 36, 37])]
+    [1, 3, 0]
+    """
+
+    # find_many()で一度に作る(var, 前半の組み合わせ)の数
+    chunk = 2**22
+
+    def __init__(self, caplist: list = CAPLIST_E24, combo: int = 2):
+        self.caplist = tuple(caplist)
+        self.combo = combo
+        self.values = np.asarray(caplist, dtype=float)
+        self.half = combo // 2
+        self.left = _multisets(len(self.values), self.half)
+        self.right = _multisets(len(self.values), combo - self.half)
+        self.l_sum = _fold(self.values, self.left)
+        r_sum = _fold(self.values, self.right)
+        self.order = np.argsort(r_sum, kind='stable')
+        self.r_sorted = r_sum[self.order]
+        # 足す順番による丸め誤差の分だけ広く探して、あとで厳密に比べる
+        self.eps = 1e-9 * combo * np.abs(self.values).max(initial=0)
+
+    def __repr__(self):
+        return 'CombinationIndex(caplist=<{} values>, combo={})'.format(
+            len(self.caplist), self.combo)
+
+    def find(self, var) -> np.ndarray:
+        """合計がvarになる組み合わせのインデックス(shape=(n, combo))
+        行の順番はcombinations_with_replacement()と同じ"""
+        return self.find_many([var])[0]
+
+    def find_many(self, targets) -> list:
+        """targetsそれぞれについてfind()した結果のリスト"""
+        targets = np.asarray(targets, dtype=float).ravel()
+        blocks = list(self._scan(targets, targets))
+        label = np.concatenate([b[0] for b in blocks])
+        ix = np.concatenate([b[1] for b in blocks])
+        # varごとに、組み合わせをcombinations_with_replacement()の順に並べる
+        order = np.lexsort(np.vstack([ix.T[::-1], label]))
+        label, ix = label[order], ix[order]
+        bounds = np.searchsorted(label, np.arange(len(targets) + 1))
+        return [ix[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def near(self, var, tol: float = 0, rel_tol: float = 0, top: int = None):
+        """合計がvar±max(tol, rel_tol*|var|)の組み合わせを誤差の小さい順に返す
+
+        return: (ix, total)
+            ix: 組み合わせのインデックス(shape=(n, combo))
+            total: 組み合わせの合計(誤差はtotal - var)
+
+        >>> index = CombinationIndex([1.1, 2.2, 3.3], 2)
+        >>> index.find(3.3)  # 1.1 + 2.2 = 3.3000000000000003
+        array([], shape=(0, 2), dtype=int64)
+        >>> index.near(3.3, tol=1e-9)[0]
+        array([[0, 1]])
+        """
+        width = max(tol, rel_tol * abs(var))
+        return self.within(var - width, var + width, top, center=var)
+
+    def within(self, lo: float, hi: float, top: int = None,
+               center: float = None):
+        """合計がlo~hiの組み合わせを、centerとの差の小さい順に返す
+        centerのデフォルトは(lo + hi) / 2
+        topを指定すると上位top個だけ返す(途中でも上位top個だけ残す)
+
+        return: (ix, total) near()と同じ
+
+        >>> index = CombinationIndex([10, 12, 16, 18, 20, 24], 2)
+        >>> ix, total = index.within(35, 38)
+        >>> total
+        array([36., 36., 36., 38.])
+        >>> ix, total = index.within(35, 38, top=2, center=38)
+        >>> ix
+        array([[3, 4],
+               [1, 5]])
+        """
+        center = (lo + hi) / 2 if center is None else center
+        if top is None:
+            return self._ranked(lo, hi, center, top)
+        # centerの近くから範囲を倍々に広げ、top個見つかったら止める
+        width = max(hi - center, center - lo) * 2.0**-20
+        while True:
+            a, b = max(lo, center - width), min(hi, center + width)
+            ix, total = self._ranked(a, b, center, top)
+            if len(ix) >= top or (a, b) == (lo, hi):
+                return ix, total
+            width *= 2
+
+    def _ranked(self, lo, hi, center, top):
+        """within()の1回分: 合計がlo~hiの組み合わせをcenterに近い順に並べる"""
+        ix = np.zeros((0, self.combo), dtype=np.intp)
+        total = np.zeros(0)
+        for _, ix_b, total_b in self._scan(np.array([lo]), np.array([hi])):
+            ix = np.concatenate([ix, ix_b])
+            total = np.concatenate([total, total_b])
+            err = np.abs(total - center)
+            if top is not None and len(err) > top:
+                # top番目の誤差以下だけ残してから並べる
+                kth = np.partition(err, top - 1)[top - 1]
+                keep = err <= kth
+                ix, total, err = ix[keep], total[keep], err[keep]
+            # 誤差の小さい順、同じ誤差はcombinations_with_replacement()の順
+            order = np.lexsort(np.vstack([ix.T[::-1], err]))
+            ix, total = ix[order[:top]], total[order[:top]]
+        return ix, total
+
+    def _scan(self, lo, hi):
+        """合計がlo[i]~hi[i]の組み合わせを
+        (番号i, インデックス, 合計)のブロックごとに返すジェネレータ
+        1ブロックで調べる(i, 前半の組み合わせ)の数はchunk個まで"""
+        n_left = len(self.left)
+        rows = min(n_left, self.chunk)
+        step = max(1, self.chunk // n_left)
+        for t0 in range(0, len(lo), step):
+            for r0 in range(0, n_left, rows):
+                label, ix, total = self._block(lo[t0:t0 + step],
+                                               hi[t0:t0 + step],
+                                               slice(r0, r0 + rows))
+                yield label + t0, ix, total
+
+    def _block(self, lo, hi, rows):
+        """前半の組み合わせself.left[rows]について_scan()する"""
+        left = self.left[rows]
+        # 足す順番による丸め誤差の分だけ広く探して、あとで厳密に比べる
+        eps = self.eps + 1e-9 * np.maximum(np.abs(lo), np.abs(hi))[:, None]
+        l_sum = self.l_sum[rows]
+        start = np.searchsorted(self.r_sorted, lo[:, None] - l_sum - eps,
+                                'left').ravel()
+        stop = np.searchsorted(self.r_sorted, hi[:, None] - l_sum + eps,
+                               'right').ravel()
+        count = stop - start
+        pair = np.repeat(np.arange(len(count)), count)
+        # pairごとにstart[pair]から連番
+        offset = np.arange(len(pair)) - np.repeat(np.cumsum(count) - count,
+                                                  count)
+        label, l_ix = np.divmod(pair, len(left))
+        r_ix = self.order[start[pair] + offset]
+        # 前半の最後 <= 後半の最初 の分け方だけが組み合わせに1対1で対応する
+        if self.half and self.combo - self.half:
+            keep = left[l_ix, -1] <= self.right[r_ix, 0]
+            label, l_ix, r_ix = label[keep], l_ix[keep], r_ix[keep]
+        ix = np.concatenate([left[l_ix], self.right[r_ix]], axis=1)
+        total = _fold(self.values, ix)
+        keep = (lo[label] <= total) & (total <= hi[label])
+        return label[keep], ix[keep], total[keep]
+
+
+_cached_index = lru_cache(maxsize=16)(CombinationIndex)
+
+
+def _multisets(size: int, n: int) -> np.ndarray:
+    """range(size)から重複ありでn個選ぶ組み合わせ(shape=(m, n))"""
+    if n == 0:
+        return np.zeros((1, 0), dtype=np.intp)
+    ix = np.fromiter(chain.from_iterable(
+        combinations_with_replacement(range(size), n)), dtype=np.intp)
+    return ix.reshape(-1, n)
+
+
+def _fold(values: np.ndarray, ix: np.ndarray) -> np.ndarray:
+    """values[ix]を行ごとに左から順に足す(`sum(tpl)`と同じ丸め)"""
+    total = np.zeros(len(ix))
+    for col in ix.T:
+        total = total + values[col]
+    return total
 
 
 def has_value(var, combi_proposer_dict):
     """`combi_proposer_all()`の結果から、
     共通で含まれるvarを持つkeyをリストアップする
+    combi_proposer_dictにはPartIndexも渡せる(何度も引くときに速い)
 
     >>> cli = combi_proposer(3, [220, 240, 260], CAPLIST_E24[::2])
     >>> cli
@@ -78,11 +322,86 @@ def has_value(var, combi_proposer_dict):
     >>> has_value(68,cli)
     [240, 260]
     """
-    # `list(chain.from_iterable(v))` <- flatten tuple of tuple
-    return [
-        k for k, v in combi_proposer_dict.items()
-        if var in list(chain.from_iterable(v))
-    ]
+    if not isinstance(combi_proposer_dict, PartIndex):
+        combi_proposer_dict = PartIndex(combi_proposer_dict)
+    return combi_proposer_dict.targets_with(var)
+
+
+class PartIndex:
+    """`combi_proposer()`の結果(dict)から作る、部品 -> 組み合わせの逆引き索引
+    一度作れば部品ごと・在庫リストごとの検索で組み合わせを全部たどらない
+
+    usage:
+        `pi = PartIndex(combi_proposer(3, [220, 240, 260]))`
+        `pi.targets_with(68)`  # 68を使えるvarのリスト(has_valueと同じ)
+        `pi.combos_with(68)`  # 68を使う組み合わせ {var: tuple in tuple}
+        `pi.achievable([10, 22, 68, 150])`  # 在庫の部品だけでできる組み合わせ
+
+    >>> cli = combi_proposer(2, [22, 24, 26], [10, 11, 12, 13, 15, 16])
+    >>> pi = PartIndex(cli)
+    >>> pi.targets_with(11)
+    [22, 24, 26]
+    >>> pi.combos_with(13)
+    {24: ((11, 13),), 26: ((13, 13),)}
+    >>> pi.achievable([10, 12, 13])
+    {22: ((10, 12),), 24: ((12, 12),), 26: ((13, 13),)}
+    """
+
+    def __init__(self, combi_proposer_dict: dict):
+        self.targets = list(combi_proposer_dict)
+        # 組み合わせに通し番号をつけ、varの番号と部品の種類数を持つ
+        self.combos = []
+        target_of = []
+        n_parts = []
+        index = {}
+        for t, combos in enumerate(combi_proposer_dict.values()):
+            for combo in combos:
+                cid = len(self.combos)
+                self.combos.append(combo)
+                target_of.append(t)
+                parts = set(combo)
+                n_parts.append(len(parts))
+                for part in parts:
+                    index.setdefault(part, []).append(cid)
+        self.target_of = np.array(target_of, dtype=np.intp)
+        self.n_parts = np.array(n_parts, dtype=np.intp)
+        # 部品 -> その部品を使う組み合わせの番号(昇順)
+        self.index = {
+            part: np.array(cids, dtype=np.intp)
+            for part, cids in index.items()
+        }
+
+    def __repr__(self):
+        return 'PartIndex(targets={}, combos={}, parts={})'.format(
+            len(self.targets), len(self.combos), len(self.index))
+
+    def targets_with(self, part) -> list:
+        """partを使う組み合わせがあるvarのリスト(dictの順)"""
+        cids = self.index.get(part, np.zeros(0, dtype=np.intp))
+        return [self.targets[t] for t in np.unique(self.target_of[cids])]
+
+    def combos_with(self, part) -> dict:
+        """partを使う組み合わせ {var: tuple in tuple}"""
+        return self._group(self.index.get(part, np.zeros(0, dtype=np.intp)))
+
+    def achievable(self, stock) -> dict:
+        """stockの部品だけでできる組み合わせ {var: tuple in tuple}
+        組み合わせが1つもないvarは含まない"""
+        hits = np.zeros(len(self.combos), dtype=np.intp)
+        for part in set(stock):
+            cids = self.index.get(part)
+            if cids is not None:
+                hits[cids] += 1
+        # 組み合わせのすべての種類の部品が在庫にある
+        return self._group(np.flatnonzero(hits == self.n_parts))
+
+    def _group(self, cids) -> dict:
+        """組み合わせの番号(昇順)をvarごとにまとめる"""
+        grouped = {}
+        for cid in cids.tolist():
+            target = self.targets[self.target_of[cid]]
+            grouped.setdefault(target, []).append(self.combos[cid])
+        return {k: tuple(v) for k, v in grouped.items()}
 
 
 if __name__ == '__main__':
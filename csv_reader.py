@@ -6,60 +6,366 @@
     スペクトラムアナライザ:N9010A
 """
 
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import zip_longest
+import glob
 import os
+import numpy as np
+import pandas as pd
+from .cache import get_cache
+
+# ヘッダーから読むメタデータ: 属性名 -> ヘッダーのキー(小文字)
+META_KEYS = {
+    'start': ('start frequency', 'start freq', 'start'),
+    'stop': ('stop frequency', 'stop freq', 'stop'),
+    'rbw': ('rbw', 'res bw', 'resolution bandwidth'),
+    'points': ('points', 'number of points', 'sweep points'),
+}
 
 
-def reader_N5071(*filelist):
+def reader_N5071(*filelist,
+                 engine: str = 'c',
+                 workers: int = None,
+                 pool: str = 'thread',
+                 grid=None,
+                 cache=None):
     """ネットワークアナライザN5071からデータインポート
     USAGE:
         reader_N5071(test1.csv, test2.csv, test3.csv)
         return 3 columns pandas DataFrame
+
+    各ファイルのメタデータ(start, stop, rbw, points)は
+    `df.attrs['meta'][basename]`に入る
+    filelist: ファイル名のほかglob('*.csv')やディレクトリ(中の*.csv)も指定できる
+    engine: pd.read_csvのengine('c' or 'pyarrow')
+    workers: 指定するとworkers並列でファイルを読む
+    pool: 'thread' or 'process'
+    grid: 周波数軸(デフォルトは最初のファイルの周波数に完全一致で合わせる)
+        'first', 'union', 'intersection'か周波数の配列を指定すると、
+        すべてのファイルをその周波数に線形補間する(resample()参照)
+    cache: 読んだtraceのキャッシュ(TraceCache)
+        デフォルトはcache.get_cache(), Falseでキャッシュを使わない
     """
-    skiprows = 3
-    tempdata = pd.read_csv(filelist[0],
-                           skiprows=skiprows,
-                           engine='python',
-                           names=['Frequency', 'temp'],
-                           usecols=[0, 1],
-                           index_col=0)
-    df = pd.DataFrame(tempdata)
-    for file in filelist:
-        dff = pd.read_csv(file,
-                          skiprows=skiprows - 1,
-                          engine='python',
-                          usecols=[0, 1],
-                          index_col=0)
-        basename = os.path.splitext(os.path.basename(file))[0]
-        df[basename] = dff
-    del df['temp']
-    return df
+    return _assemble(filelist, 'Frequency', engine, workers, pool, grid,
+                     cache)
 
 
-def reader_N9010A(*filelist):
+def reader_N9010A(*filelist,
+                  engine: str = 'c',
+                  workers: int = None,
+                  pool: str = 'thread',
+                  grid=None,
+                  cache=None):
     """スペクトラムアナライザN9010Aからデータインポート
     USAGE:
         reader_N9010A(test1.csv, test2.csv, test3.csv)
         return 3 columns pandas DataFrame
 
+    各ファイルのメタデータ(start, stop, rbw, points)は
+    `df.attrs['meta'][basename]`に入る
+    filelist: ファイル名のほかglob('*.csv')やディレクトリ(中の*.csv)も指定できる
+    engine: pd.read_csvのengine('c' or 'pyarrow')
+    workers: 指定するとworkers並列でファイルを読む
+    pool: 'thread' or 'process'
+    grid: 周波数軸(デフォルトは最初のファイルの周波数に完全一致で合わせる)
+        'first', 'union', 'intersection'か周波数の配列を指定すると、
+        すべてのファイルをその周波数に線形補間する(resample()参照)
+    cache: 読んだtraceのキャッシュ(TraceCache)
+        デフォルトはcache.get_cache(), Falseでキャッシュを使わない
+
     ! 1列目しか抜き出せない...
     """
-    skiprows = 44
-    # 1ファイルだけ読み込んでindex設定用に使う
-    tempfile = filelist[0]
-    tempdata = pd.read_csv(tempfile,
-                           skiprows=skiprows,
-                           engine='python',
-                           names=['temp'])
-    df = pd.DataFrame(tempdata)
-    for file in filelist:
-        dff = pd.read_csv(file, skiprows=skiprows - 1, engine='python')
+    return _assemble(filelist, None, engine, workers, pool, grid,
+                     cache)
+
+
+def expand_files(filelist) -> list:
+    """ファイル名、glob、ディレクトリのリストをファイル名のリストにする
+    globとディレクトリの中身は名前順、それ以外は指定した順"""
+    files = []
+    for item in filelist:
+        item = os.fspath(item)
+        if os.path.isdir(item):
+            files.extend(sorted(glob.glob(os.path.join(item, '*.csv'))))
+        elif glob.has_magic(item):
+            files.extend(sorted(glob.glob(item)))
+        else:
+            files.append(item)
+    return files
+
+
+def read_traces(filelist,
+                engine: str = 'c',
+                workers: int = None,
+                pool: str = 'thread',
+                cache=None) -> list:
+    """filelistをread_trace()で読んだ(trace, meta)のリスト(filelistの順)
+    workersを指定するとスレッドかプロセスのプールで並列に読む
+    キャッシュがあればパースせずにキャッシュから読む"""
+    read = partial(cached_read_trace, engine=engine, cache=cache)
+    if not workers or workers == 1 or len(filelist) < 2:
+        return [read(file) for file in filelist]
+    executor = {'thread': ThreadPoolExecutor,
+                'process': ProcessPoolExecutor}[pool]
+    with executor(workers) as ex:
+        return list(ex.map(read, filelist))
+
+
+def _assemble(filelist,
+              index_name,
+              engine,
+              workers=None,
+              pool='thread',
+              grid=None,
+              cache=None):
+    """filelistを読んで1ファイル1列のDataFrameにする
+    indexは最初のファイルの周波数(gridを指定したらその周波数)
+    列ごとに挿入せず、2次元配列に詰めてから1回でDataFrameにする"""
+    files = expand_files(filelist)
+    if not files:
+        raise FileNotFoundError('No csv file in {}'.format(filelist))
+    traces = {}
+    meta = {}
+    results = read_traces(files, engine, workers, pool, cache)
+    for file, (trace, info) in zip(files, results):
         basename = os.path.splitext(os.path.basename(file))[0]
-        df[basename] = dff
-    del df['temp']
+        # 同じbasenameは後のファイルで上書き(列の位置は最初のまま)
+        traces[basename] = trace
+        meta[basename] = info
+    if grid is not None:
+        index, values = resample(list(traces.values()), grid)
+        df = pd.DataFrame(values,
+                          index=pd.Index(index, name=index_name),
+                          columns=list(traces))
+        df.attrs['meta'] = meta
+        return df
+    index = next(iter(traces.values())).index
+    # 最初のファイルと周波数が違えばindexに合わせる
+    aligned = [
+        t if t.index.equals(index) else t.reindex(index)
+        for t in traces.values()
+    ]
+    values = np.empty((len(index), len(aligned)),
+                      dtype=np.result_type(*(t.dtype for t in aligned)))
+    for i, trace in enumerate(aligned):
+        values[:, i] = trace.values
+    df = pd.DataFrame(values,
+                      index=index.rename(index_name),
+                      columns=list(traces))
+    df.attrs['meta'] = meta
     return df
 
 
+def resample(traces: list, grid='first'):
+    """周波数の違うtraces(pd.Seriesのリスト)を共通の周波数gridに線形補間する
+    同じ周波数軸のtraceはまとめて、補間の重みを1回だけ計算して
+    2次元配列で補間する。traceの周波数範囲の外はNaN
+
+    args:
+        traces: index=周波数のpd.Seriesのリスト
+        grid: 'first': 最初のtraceの周波数
+              'union': すべてのtraceの周波数の和集合
+              'intersection': unionのうち、すべてのtraceの範囲内にある周波数
+              配列: その周波数(np.linspaceなど)
+
+    return: (grid, values) values.shape=(len(grid), len(traces))
+
+    >>> a = pd.Series([0., 10., 20.], index=[100., 200., 300.])
+    >>> b = pd.Series([5., 15.], index=[150., 250.])
+    >>> grid, values = resample([a, b], 'union')
+    >>> grid
+    array([100., 150., 200., 250., 300.])
+    >>> values
+    array([[ 0., nan],
+           [ 5.,  5.],
+           [10., 10.],
+           [15., 15.],
+           [20., nan]])
+    >>> resample([a, b], 'intersection')[0]
+    array([150., 200., 250.])
+    """
+    axes = [np.asarray(t.index, dtype=float) for t in traces]
+    if isinstance(grid, str):
+        if grid == 'first':
+            grid = axes[0]
+        elif grid in ('union', 'intersection'):
+            union = np.unique(np.concatenate(axes))
+            if grid == 'intersection':
+                lo = max(x.min() for x in axes)
+                hi = min(x.max() for x in axes)
+                union = union[(union >= lo) & (union <= hi)]
+            grid = union
+        else:
+            raise ValueError(
+                "grid must be 'first', 'union', 'intersection' or an array")
+    grid = np.asarray(grid, dtype=float)
+    values = np.full((len(grid), len(traces)), np.nan)
+    # 同じ周波数軸のtraceをまとめる
+    groups = {}
+    for i, x in enumerate(axes):
+        groups.setdefault(x.tobytes(), []).append(i)
+    for cols in groups.values():
+        x = axes[cols[0]]
+        y = np.column_stack([np.asarray(traces[i], dtype=float)
+                             for i in cols])
+        order = np.argsort(x, kind='stable')
+        values[:, cols] = _interp(grid, x[order], y[order])
+    return grid, values
+
+
+def _interp(grid, x, y):
+    """np.interpを2次元のy(列ごとのtrace)にまとめて行う
+    xの範囲外はNaN"""
+    out = np.full((len(grid), y.shape[1]), np.nan)
+    if len(x) == 0:
+        return out
+    inside = (grid >= x[0]) & (grid <= x[-1])
+    if len(x) == 1:
+        out[inside] = y[0]
+        return out
+    g = grid[inside]
+    pos = np.clip(np.searchsorted(x, g, 'right') - 1, 0, len(x) - 2)
+    w = ((g - x[pos]) / (x[pos + 1] - x[pos]))[:, None]
+    out[inside] = y[pos] * (1 - w) + y[pos + 1] * w
+    return out
+
+
+def cached_read_trace(file, engine: str = 'c', cache=None):
+    """read_trace()の結果をcacheから読む。なければ読んでcacheに入れる
+    cache: TraceCache(デフォルトはcache.get_cache()), Falseなら使わない"""
+    cache = get_cache() if cache is None else cache
+    if cache is False:
+        return read_trace(file, engine)
+    params = {'reader': 'read_trace', 'engine': engine}
+    hit = cache.get(file, params)
+    if hit is not None:
+        return hit
+    trace, meta = read_trace(file, engine)
+    cache.put(file, params, trace, meta)
+    return trace, meta
+
+
+def read_trace(file, engine: str = 'c'):
+    """計測器のCSVを1回だけ読んで(pd.Series, meta)を返す
+    先頭から1行ずつ読み、1列目が数値になった行からをデータとして
+    pd.read_csvに渡す。それより前の行はメタデータとして読む
+
+    return:
+        trace: index=周波数, values=1列目のデータ(pd.Series)
+        meta: start, stop, rbw, points, skiprows, header(dict)
+    """
+    with open(file, 'rb') as f:
+        header = _skip_header(f)
+        data = pd.read_csv(f, header=None, usecols=[0, 1], engine=engine)
+    trace = pd.Series(data[1].values, index=pd.Index(data[0].values))
+    meta = parse_header(header)
+    # ヘッダーにないものはデータから
+    if meta['start'] is None and len(trace):
+        meta['start'] = float(trace.index[0])
+    if meta['stop'] is None and len(trace):
+        meta['stop'] = float(trace.index[-1])
+    if meta['points'] is None:
+        meta['points'] = len(trace)
+    meta['skiprows'] = len(header)
+    return trace, meta
+
+
+def iter_rows(*filelist, chunksize: int = 100000, engine: str = 'c'):
+    """filelistをchunksize行ずつ読み、1ファイル1列のDataFrameを返すジェネレータ
+    ファイル全体を読まないので、大きなCSVもメモリを増やさずに処理できる
+    (sketch.streaming_noisefloor()などに渡す)
+    周波数は最初のファイルのものを使う
+    行数が違うファイルがあれば、短いファイルの名前でValueErrorを出す
+    filelist: reader_N9010A()と同じ(globやディレクトリも指定できる)
+    engine: pd.read_csvのengine('c' or 'python', pyarrowは分割して読めない)"""
+    files = expand_files(filelist)
+    if not files:
+        raise FileNotFoundError('No csv file in {}'.format(filelist))
+    names = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    handles = [open(f, 'rb') for f in files]
+    try:
+        readers = []
+        for f in handles:
+            _skip_header(f)
+            readers.append(pd.read_csv(f, header=None, usecols=[0, 1],
+                                       engine=engine, chunksize=chunksize))
+        for chunks in zip_longest(*readers):
+            sizes = [0 if c is None else len(c) for c in chunks]
+            if min(sizes) != max(sizes):
+                short = [f for f, n in zip(files, sizes) if n < max(sizes)]
+                raise ValueError('Files have fewer rows than the others: '
+                                 '{}'.format(short))
+            values = np.column_stack([c[1].values for c in chunks])
+            yield pd.DataFrame(values, index=pd.Index(chunks[0][0].values),
+                               columns=names)
+    finally:
+        for f in handles:
+            f.close()
+
+
+def _skip_header(f) -> list:
+    """fを1列目が数値の行の先頭まで進めて、それより前の行を返す"""
+    header = []
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line or _is_numeric(line):
+            break
+        header.append(line.decode('latin-1'))
+    f.seek(pos)
+    return header
+
+
+def parse_header(lines) -> dict:
+    """ヘッダー行("key,value[,unit]")をメタデータのdictにする
+    値はMETA_KEYSのキーのほかheaderにすべて文字列で入る
+
+    >>> meta = parse_header(['Start Frequency,100000,Hz', 'RBW,300,Hz',
+    ...                      'DATA'])
+    >>> meta['start'], meta['rbw'], meta['stop']
+    (100000.0, 300.0, None)
+    >>> meta['header']
+    {'Start Frequency': '100000,Hz', 'RBW': '300,Hz', 'DATA': ''}
+    """
+    header = {}
+    for line in lines:
+        key, _, value = line.lstrip('\ufeff\xef\xbb\xbf').strip().partition(',')
+        key = key.strip('!#" ')
+        if key:
+            header[key] = value.strip()
+    lower = {k.lower(): v for k, v in header.items()}
+    meta = {}
+    for name, keys in META_KEYS.items():
+        meta[name] = next(
+            (_first_number(lower[k]) for k in keys if k in lower), None)
+    if meta['points'] is not None:
+        meta['points'] = int(meta['points'])
+    meta['header'] = header
+    return meta
+
+
+def _first_number(value: str):
+    """"100000,Hz"のような値の最初の数値(なければNone)"""
+    for field in value.split(','):
+        try:
+            return float(field)
+        except ValueError:
+            continue
+    return None
+
+
+def _is_numeric(line: bytes) -> bool:
+    """CSVの行の1列目が数値か"""
+    field = line.lstrip(b'\xef\xbb\xbf').split(b',', 1)[0].strip()
+    try:
+        float(field)
+    except ValueError:
+        return False
+    return True
+
+
 def nearest_x(df, value):
     """valueに最も近い値下がったところのindexを返す"""
     down = df.max() - value
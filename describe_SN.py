@@ -2,23 +2,88 @@
 
 import pandas as pd
 import numpy as np
-from scipy import stats
-def describe_SN(data, freq):
+from .dbmw import noisefloor
+def describe_SN(data, freq, width: float=0.02):
     """SN比の計算
     * 特定の周波数: atfreq
-    * atfreq付近の平均値: sig
+    * atfreq付近(freq±width)の平均値: sig
     * ノイズフロア=全体の四分位境界値: noise
     * SN比:sn  # snはsigとnoiseの差分
-    
+
     以上をpandas DataFrame形式(表形式)で返す
+    freqが1つなら行がdataの列
+    freqがリストなら行が(周波数, dataの列)のMultiIndexで、
+    列はatfreq, シグナル平均, ノイズフロア, SN比
+
+    >>> f = np.round(np.arange(149.9, 150.1, 0.01), 2)
+    >>> df = pd.DataFrame({'a': np.arange(len(f)) * 1.,
+    ...                    'b': np.arange(len(f)) * -2.}, index=f)
+    >>> describe_SN(df, 150.0)
+       150.0kHz  シグナル平均  ノイズフロア   SN比
+    a      10.0    10.0    4.75  5.25
+    b     -20.0   -20.0  -28.50  8.50
+    >>> describe_SN(df, [149.95, 150.0])['SN比'].tolist()
+    [0.25, 18.5, 5.25, 8.5]
+    >>> df.iloc[3, 0] = -np.inf  # mw2db(0)
+    >>> describe_SN(df, 150.0)['シグナル平均'].tolist()
+    [10.0, -20.0]
     """
-    atfreq = data.loc[freq]
-    sig = data[freq-0.02:freq+0.02].mean()
-    noise = data.apply(lambda x: stats.scoreatpercentile(x, 25))
-    sn = pd.DataFrame([atfreq, sig]).max() - noise
-    dicc = {'{}kHz'.format(freq):atfreq,
-            'シグナル平均': sig,
-            'ノイズフロア': noise,
-            'SN比': sn}
-    df = pd.DataFrame(dicc, columns=dicc.keys())
-    return df
+    index = np.asarray(data.index, dtype=float)
+    values = np.asarray(data, dtype=float)
+    freqs = np.atleast_1d(np.asarray(freq, dtype=float))
+    n = len(freqs)
+    # atfreqの位置とfreq±widthの窓の両端を1回で探す
+    pos = np.searchsorted(
+        index, np.concatenate([freqs, freqs - width, freqs + width]))
+    at, lo, hi = pos[:n], pos[n:2 * n], pos[2 * n:]
+    # 窓の右端は含む
+    hi += (hi < len(index)) & (index[np.minimum(hi, len(index) - 1)] ==
+                               freqs + width)
+    missing = (at >= len(index)) | (index[np.minimum(at, len(index) - 1)] !=
+                                    freqs)
+    if missing.any():
+        raise KeyError(freqs[missing].tolist())
+    atfreq = values[at]
+    sig = _window_mean(_window_sums(values, lo, hi))
+    noise = noisefloor(values)
+    return _sn_frame(freq, data.columns, atfreq, sig, noise)
+
+
+def _window_sums(values, lo, hi):
+    """values[lo:hi]ごとの(有限値の和, 有限値の数, +infの数, -infの数)
+    累積和の差でまとめて求める(shape=(4, 窓の数, 列数))
+    infは和に入れずに数えるので、窓の外の-inf(mw2db(0))で和が壊れない"""
+    finite = np.isfinite(values)
+    parts = np.stack([np.where(finite, values, 0), finite,
+                      values == np.inf, values == -np.inf])
+    cum = np.concatenate([np.zeros((4, 1, values.shape[1])),
+                          parts.cumsum(axis=1)], axis=1)
+    return cum[:, hi] - cum[:, lo]
+
+
+def _window_mean(sums):
+    """_window_sums()からNaNを除いた平均(DataFrame.mean()と同じくinfを含めば±inf)"""
+    total, count, pos, neg = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+    mean = np.where(pos > 0, np.inf, np.where(neg > 0, -np.inf, mean))
+    return np.where((pos > 0) & (neg > 0), np.nan, mean)
+
+
+def _sn_frame(freq, columns, atfreq, sig, noise):
+    """describe_SN()の結果のDataFrame
+    atfreq, sig: shape=(周波数の数, 列数), noise: shape=(列数,)"""
+    sn = np.fmax(atfreq, sig) - noise
+    if np.ndim(freq) == 0:
+        dicc = {'{}kHz'.format(freq): atfreq[0],
+                'シグナル平均': sig[0],
+                'ノイズフロア': noise,
+                'SN比': sn[0]}
+        return pd.DataFrame(dicc, index=columns)
+    freqs = np.asarray(freq, dtype=float)
+    index = pd.MultiIndex.from_product([freqs, columns],
+                                       names=['freq', columns.name])
+    return pd.DataFrame({'atfreq': atfreq.ravel(),
+                         'シグナル平均': sig.ravel(),
+                         'ノイズフロア': np.tile(noise, len(freqs)),
+                         'SN比': sn.ravel()}, index=index)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""E系列のコンデンサからバイナリコンデンサバンクを設計する計算ライブラリ"""
+from collections import namedtuple
+from itertools import combinations_with_replacement
+import numpy as np
+from .clist import CAPLIST_E24
+from .lcbin import resonance_freq
+
+BankDesign = namedtuple('BankDesign', 'gap values parts nodes exact')
+BankDesign.__doc__ = """design_bank()の結果
+    gap: 帯域内で同調できない最大の幅[kHz]
+    values: 各チャンネルの容量[pF](昇順)
+    parts: 各チャンネルを構成する部品の組み合わせ(tuple in tuple)
+    nodes: 探索したノード数
+    exact: 探索を打ち切らずに最適解を確かめたらTrue
+"""
+
+
+def design_bank(c_num: int,
+                lmh: float,
+                band,
+                caplist: list = CAPLIST_E24,
+                k: int = 2,
+                c_para: float = 0,
+                c_ser: float = 0,
+                rtol: float = 0,
+                max_nodes: int = 2000,
+                n_jobs: int = None) -> BankDesign:
+    """帯域bandを覆い、隣り合う同調周波数の最大間隔が最小になる
+    c_num個のコンデンサの組を探す
+    各コンデンサはcaplistの部品を最大k個並列にした合計値
+
+    Lcbinはc_list()の理想的な倍々の容量を仮定するが、
+    実際にはE系列の部品しか使えないので、部品の組み合わせから選ぶ。
+
+    探索は分枝限定法で行う。
+    容量を小さい順に決めていくと、次に選ぶ容量v以下の合計容量
+    (=f(v)以上の同調周波数)はそれ以降の選択で変わらないので、
+    その範囲の最大間隔が下界になる。
+    候補の容量すべての下界を配列でまとめて計算し、
+    下界の小さい順に探索して、暫定解以上の枝を切る。
+    暫定解の初期値は、間隔の上限を二分探索する貪欲法で作る。
+
+    usage:
+        `design_bank(6, 12.5, band=(100, 300), k=2)`
+
+    args:
+        c_num: コンデンサの数(int)
+        lmh: Indactance[mH](float)
+        band: (f_lo, f_hi)[kHz] 覆う帯域(tuple)
+        caplist: 使用できる部品の容量[pF]のリスト(デフォルトE24系列)
+        k: 1チャンネルあたりの最大部品数
+        c_para, c_ser: Lcbinと同じ
+        rtol: 暫定解の(1-rtol)倍以上の下界の枝も切る
+            最適解との差がrtol以内の解でよいときに探索が速くなる
+        max_nodes: 探索するノード数の上限(Noneで無制限)
+            上限に達したらそれまでの最良解を返す(exact=False)
+        n_jobs: 指定すると最初のコンデンサの候補ごとにプロセスプールで探索する
+            max_nodesはプロセスごとの上限になる
+
+    return: BankDesign(gap, values, parts, nodes, exact)
+
+    >>> d = design_bank(4, 12.5, (120, 300), k=1)
+    >>> d.values
+    (3.9, 24.0, 33.0, 43.0)
+    >>> round(d.gap, 3)
+    21.699
+    >>> d.exact
+    True
+    """
+    values, parts = candidates(caplist, k)
+    f_lo, f_hi = band
+    # f_loより低い同調周波数にしかならない容量は使わない
+    useful = values <= _csum_at(f_lo, lmh, c_para, c_ser)
+    values = values[useful]
+    parts = [p for p, u in zip(parts, useful) if u]
+    search = _Search(values, c_num, lmh, band, c_para, c_ser, rtol,
+                     max_nodes)
+    search.seed()
+
+    if n_jobs:
+        from concurrent.futures import ProcessPoolExecutor
+        # 貪欲法の暫定解を各プロセスの枝刈りに使う
+        first = search.branches()
+        groups = [first[i::n_jobs] for i in range(n_jobs)]
+        with ProcessPoolExecutor(n_jobs) as executor:
+            results = list(
+                executor.map(_search_group, [search] * n_jobs, groups))
+        gap, best_idx = min(results, key=lambda r: r[0])[:2]
+        nodes = sum(r[2] for r in results)
+        exact = all(r[3] for r in results)
+    else:
+        search.run()
+        gap, best_idx, nodes = search.best, search.best_idx, search.nodes
+        exact = not search.truncated
+    if best_idx is None:
+        raise ValueError('No bank of {} capacitors found'.format(c_num))
+    return BankDesign(gap, tuple(values[i].item() for i in best_idx),
+                      tuple(parts[i] for i in best_idx), nodes, exact)
+
+
+def candidates(caplist: list = CAPLIST_E24, k: int = 2):
+    """caplistの部品を1~k個並列にした合計容量の候補
+    同じ合計値は部品数の少ない組み合わせを残す
+
+    return:
+        values: 合計容量(昇順, np.ndarray)
+        parts: valuesに対応する部品の組み合わせ(list of tuple)
+
+    >>> values, parts = candidates([10, 22, 47], 2)
+    >>> values
+    array([10, 20, 22, 32, 44, 47, 57, 69, 94])
+    >>> parts[3]
+    (10, 22)
+    """
+    combos = [
+        c for n in range(1, k + 1)
+        for c in combinations_with_replacement(caplist, n)
+    ]
+    sums = np.array([sum(c) for c in combos])
+    # 部品数の少ない順に並んでいるので、np.uniqueは最初の組み合わせを残す
+    _, first = np.unique(np.round(sums, 9), return_index=True)
+    return sums[first], [combos[i] for i in first]
+
+
+def _csum_at(fkhz, lmh, c_para=0, c_ser=0):
+    """同調周波数fkhz[kHz]になるコンデンサの合計容量[pF]
+    (c_para, c_serを除いた分)"""
+    c_total = 1 / ((2 * np.pi * np.asarray(fkhz) * 1e3)**2 * lmh * 1e-3) * 1e12
+    if c_ser != 0:
+        with np.errstate(divide='ignore'):
+            c_total = np.where(c_total < c_ser,
+                               1 / (1 / c_total - 1 / c_ser), np.inf)
+    return c_total - c_para
+
+
+def _search_group(search, branches):
+    """プロセスプール用: branchesの枝だけを探索する"""
+    for v_idx in branches:
+        if search.truncated:
+            break
+        search.descend((), np.zeros(1), 0.0, v_idx)
+    return (search.best, search.best_idx, search.nodes,
+            not search.truncated)
+
+
+class _Search:
+    """design_bank()の分枝限定法"""
+
+    def __init__(self, values, c_num, lmh, band, c_para, c_ser, rtol,
+                 max_nodes):
+        self.values = values
+        self.c_num = c_num
+        self.lmh = lmh
+        self.f_lo, self.f_hi = band
+        self.c_para = c_para
+        self.c_ser = c_ser
+        self.rtol = rtol
+        self.max_nodes = max_nodes
+        # 帯域の上端f_hiになる合計容量
+        self.c_top = _csum_at(self.f_hi, lmh, c_para, c_ser)
+        self.best = np.inf
+        self.best_idx = None
+        self.nodes = 0
+        self.truncated = False
+
+    def freq(self, csum):
+        """合計容量csum[pF]の同調周波数を帯域内に切り詰めた値[kHz]"""
+        cpf = self.c_para + csum
+        with np.errstate(divide='ignore'):
+            if self.c_ser != 0:
+                cpf = 1 / ((1 / cpf) + (1 / self.c_ser))
+            f = resonance_freq(self.lmh * 1e-3, cpf * 1e-12) / 1000
+        return np.clip(f, self.f_lo, self.f_hi)
+
+    def next_max(self, csum, gap):
+        """合計容量csumの次の同調周波数との間隔をgap未満にできる最大の容量"""
+        f_next = self.freq(csum) - gap
+        with np.errstate(invalid='ignore'):
+            c_next = _csum_at(np.maximum(f_next, self.f_lo), self.lmh,
+                              self.c_para, self.c_ser)
+        return np.where(f_next > self.f_lo, c_next, np.inf)
+
+    def levels(self, sums):
+        """合計容量の集合sums(昇順, 先頭は0)のうち同調する容量"""
+        return sums if self.c_para > 0 else sums[..., 1:]
+
+    def bounds(self, chosen, sums, total, start):
+        """次にvalues[start:]を選んだときの下界
+        最後の1個のときは、下界が暫定解より小さい候補だけ
+        実際の最大間隔を計算する
+        """
+        r = self.c_num - len(chosen) - 1
+        stop = len(self.values) - r
+        cand = self.values[start:stop]
+
+        # v以下の合計容量(= f(v)以上の同調周波数)は今後変わらない
+        level = self.levels(sums)
+        f_fixed = np.concatenate([[self.f_hi], self.freq(level)])
+        gap_fixed = np.maximum.accumulate(
+            np.concatenate([[0], -np.diff(f_fixed)]))
+        cnt = np.searchsorted(level, cand, 'right')
+        bound = np.maximum(gap_fixed[cnt], f_fixed[cnt] - self.freq(cand))
+        # 残りr個を最大の候補にしても下端に届かない分
+        reach = self.freq(total + cand + r * self.values[-1]) - self.f_lo
+        # vより大きい合計容量は、これまでの合計容量の集合Aを
+        # 残りr個の部分和(2**r通り)だけずらしたものの和集合になる。
+        # 幅ΣAの塊が2**r個では、f(v)~f_loのうち塊で覆えない長さを
+        # 2**r+1個以下の間隔で分けることになる
+        spread = total + cand
+        start_c = np.maximum(cand, self.c_top)
+        width = self.freq(start_c) - self.freq(start_c + spread)
+        uncovered = self.freq(cand) - self.f_lo - 2**r * width
+        bound = np.maximum(np.maximum(bound, reach), uncovered / (2**r + 1))
+        if r > 0:
+            if np.isfinite(self.best):
+                # 間隔を暫定解未満にするには、次の容量は今の合計容量Tから
+                # 間隔が暫定解未満の容量までしか大きくできない。
+                # r回大きくしても下端に届かなければ枝を切る
+                limit = self.best * (1 - self.rtol)
+                reach_c = total + cand
+                for _ in range(r):
+                    reach_c = reach_c + self.next_max(reach_c, limit)
+                bound[self.freq(reach_c) - self.f_lo >= limit] = np.inf
+            return bound
+
+        # 最後の1個: すべての合計容量から最大間隔を計算する
+        alive = np.flatnonzero(bound < self.best)
+        merged = np.sort(np.concatenate(
+            [np.broadcast_to(sums, (len(alive), len(sums))),
+             sums + cand[alive, None]], axis=1), axis=1)
+        f = self.freq(self.levels(merged))
+        edges = np.column_stack([
+            np.full(len(alive), self.f_hi), f,
+            np.full(len(alive), self.f_lo)])
+        bound[alive] = (-np.diff(edges, axis=1)).max(axis=1)
+        return bound
+
+    def seed(self, iterations: int = 30):
+        """貪欲法で暫定解を作る
+        間隔の上限gapを二分探索し、各段で下界がgap未満の最大の容量を選ぶ
+        """
+        lo, hi = 0.0, float(self.f_hi - self.f_lo)
+        best = self.best
+        for _ in range(iterations):
+            gap = (lo + hi) / 2
+            # bounds()の枝刈りにgapを使う
+            self.best = gap
+            found = self.greedy()
+            self.best = best
+            if found is None:
+                lo = gap
+                continue
+            hi = found[0]
+            if found[0] < best:
+                best, self.best_idx = found
+            self.best = best
+            if hi - lo <= 1e-6 * hi:
+                break
+
+    def greedy(self):
+        """下界がself.best未満の最大の容量を順に選ぶ
+        return: (gap, index) 見つからなければNone"""
+        chosen, sums, total, start = (), np.zeros(1), 0.0, 0
+        for _ in range(self.c_num):
+            bound = self.bounds(chosen, sums, total, start)
+            ok = np.flatnonzero(bound < self.best)
+            if len(ok) == 0:
+                return None
+            v_idx = start + int(ok[-1])
+            chosen += (v_idx, )
+            sums = np.sort(np.concatenate([sums, sums + self.values[v_idx]]))
+            total += self.values[v_idx]
+            start = v_idx + 1
+        return float(bound[ok[-1]]), chosen
+
+    def branches(self):
+        """最初のコンデンサの候補を下界の小さい順に返す"""
+        bound = self.bounds((), np.zeros(1), 0.0, 0)
+        order = np.argsort(bound, kind='stable')
+        return [int(i) for i in order if bound[i] < self.best]
+
+    def run(self):
+        """探索して self.best, self.best_idx を更新する"""
+        self.expand((), np.zeros(1), 0.0, 0)
+
+    def expand(self, chosen, sums, total, start):
+        """chosenの次の候補values[start:]を下界の小さい順に探索する"""
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            self.truncated = True
+            return
+        bound = self.bounds(chosen, sums, total, start)
+        order = np.argsort(bound, kind='stable')
+        last = len(chosen) + 1 == self.c_num
+        for i in order:
+            if bound[i] >= self.best * (1 - self.rtol):
+                break
+            if last:
+                self.best = float(bound[i])
+                self.best_idx = chosen + (start + int(i), )
+                break
+            self.descend(chosen, sums, total, start + int(i))
+            if self.truncated:
+                return
+
+    def descend(self, chosen, sums, total, v_idx):
+        """values[v_idx]を選んで次の段を探索する"""
+        self.nodes += 1
+        v = self.values[v_idx]
+        sums = np.sort(np.concatenate([sums, sums + v]))
+        self.expand(chosen + (v_idx, ), sums, total + v, v_idx + 1)
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 """ コンデンサ組み合わせバイナリ表を出力する計算ライブラリ"""
 
+from math import comb
 import os
 from IPython.display import display
 import numpy as np
@@ -19,6 +20,7 @@ class Lcbin(pd.DataFrame):
             c_initial: float = 0,
             c_para: float = 0,
             c_ser: float = 0,
+            dtype=int,
     ):
         """
         # Quick Start:
@@ -55,6 +57,8 @@ class Lcbin(pd.DataFrame):
             c_res: Resolution of capacitance[pf](float)
             c_num: Number of capacitance[uF](int)
             lmh: Indactance[mH](float)
+            dtype: ビット列のデータ型(デフォルトint)
+                np.uint8を指定するとビット列のメモリが1/8になる
 
         self: Binary table (pd.DataFrame)
             ビットテーブルを出力する
@@ -72,10 +76,20 @@ class Lcbin(pd.DataFrame):
         `bc.to_csv()`
         条件をパースしてcsvファイルを生成する。
         引数directoryを指定することで所定のディレクトリに保存する。
+        chunksize行ずつ書き出し、fmt='npy', 'npz', 'parquet'でバイナリ形式にもできる。
 
         `bc.dump()`
         pandas 初期設定の省略表示を無視して全行列を標準出力に表示
 
+        `bc.nearest(f_khz, k=1)`
+        同調周波数f_khzに近い行をk行ずつ返す(f_khzは配列でもよい)
+
+        `bc.within(f_lo, f_hi)`
+        同調周波数がf_lo~f_hiの行をfkHz昇順で返す
+
+        `bc.switching_plan(f_khz=None, ix=None, order='nearest')`
+        リレーの切り替え回数が少ない順に行を並べ、各ステップでON/OFFするチャンネルを返す
+
 
         # 行数テスト
         # 行の長さは2のn乗
@@ -130,7 +144,8 @@ class Lcbin(pd.DataFrame):
         # >>> bc.dump(): すべての行列をプリント(省略しない)
         # >>> bc.to_csv(): 条件をパースしてファイル名を自動的にアサインしてcsvに保存
         """
-        super().__init__(binary_array(c_num))
+        bits = binary_array(c_num, dtype)
+        super().__init__(bits, copy=False)
         # Required
         self._c_res = c_res
         self._c_num = c_num
@@ -148,41 +163,69 @@ class Lcbin(pd.DataFrame):
         # UserWarning: Pandas doesn't allow columns to be created
         # via a new attribute name <- 仕方ないワーニングがでる
         # 「今後array列が作れなくなる副作用がある」という意味のワーニング
-        self.array = self.iloc[:, :c_num].values  # Do not use `bc['array']`
+        self.array = bits  # Do not use `bc['array']`
 
         # 合計コンデンサ列CpF & 同調周波数列fkHz
-        self['CpF'] = c_para + (self.columns.values * self.array).sum(1)
-        if c_ser != 0:  # Evade 0 div warning
-            self.CpF = 1 / ((1 / self.CpF) + (1 / c_ser))
-
-        def resonance_freq(l, c):
-            """同調周波数を返すクロージャ"""
-            return 1 / (2 * np.pi * np.sqrt(l * c))
+        # ビット行列との積ではなく、行番号(=バイナリコード)から直接計算する
+        codes = np.arange(2**c_num)
+        self['CpF'] = capacitance(codes, c_res, c_num, c_initial, c_para,
+                                  c_ser)
+        # CpF=0の行(c_para=0)はinf
+        with np.errstate(divide='ignore'):
+            self['fkHz'] = resonance_freq(self._lmh * 1e-3,
+                                          self['CpF'].values * 1e-12) / 1000
 
-        self['fkHz'] = resonance_freq(self._lmh * 1e-3,
-                                      self.CpF * 1e-12) / 1000
-
-    def to_csv(self, directory=os.getcwd(), sort: str = None, *args, **kwargs):
+    def to_csv(self,
+               directory=os.getcwd(),
+               sort: str = None,
+               *args,
+               fmt: str = 'csv',
+               chunksize: int = 2**16,
+               **kwargs):
         """save to csv.
         default current directory
         インスタンス化した際のパラメータをパースして、ファイル名を自動的に決める
         デフォルトではカレントディレクトリ下にファイルを保存する
+
+        chunksize行ずつ書き出すので、書き出し中のメモリは表全体の並べ替えや
+        コピーを作らない。
+        fmtに'npy', 'npz', 'parquet'を指定するとバイナリ形式で保存する。
+        (詳しくはexport_table()を参照)
         """
-        init = 'init' + str(self._c_initial)
-        res = 'res' + str(self._c_res)
-        pat = 'pat' + str(self._c_num)
-        lmh = 'l' + str(self._lmh)
-
-        # ドットをp(pointの意味)に変換(ファイルネームに.は紛らわしい)
-        name = [s.replace('.', 'p') for s in (init, res, pat, lmh)]
-        name.append('.csv')
-        name.insert(0, '/')
-        name.insert(0, directory)
-        filename = ''.join(name)
-        if sort:
-            self.table.sort_values(sort).to_csv(filename, *args, **kwargs)
-        else:
-            self.table.to_csv(filename, *args, **kwargs)
+        return export_table(self, directory, sort, *args, fmt=fmt,
+                            chunksize=chunksize, **kwargs)
+
+    def _take(self, codes):
+        """行番号codesの行をDataFrameで返す(export_table()用)"""
+        return self.iloc[codes]
+
+    def masks(self, ix):
+        """行番号ix(配列)のONにするチャンネルをビットマスクでまとめて返す
+        ビットkがチャンネルk+1に対応する(=行番号そのもの)
+
+        >>> bc = Lcbin(100, 6, 10)
+        >>> bc.masks([6, -1, 1])
+        array([ 6, 63,  1])
+        """
+        return np.arange(len(self))[ix]
+
+    def switching_plan(self, f_khz=None, ix=None, order='nearest', start=0):
+        """f_khzまたは行番号ixの行を順に切り替えるときの手順を返す
+        詳しくはswitching_plan()を参照
+
+        >>> bc = Lcbin(10, 4, 12.5)
+        >>> bc.switching_plan(ix=[15, 1, 14, 6])
+           ix        fkHz  mask         on  off  toggles
+        0   1  450.158158     1        [1]   []        1
+        1  15  116.230337    15  [2, 3, 4]   []        3
+        2  14  120.309828    14         []  [1]        1
+        3   6  183.776298     6         []  [4]        1
+
+        # 与えた順のままだと切り替え回数が増える
+        >>> int(bc.switching_plan(ix=[15, 1, 14, 6], order=None).toggles.sum())
+        12
+        """
+        return switching_plan(self, f_khz, ix, order, start)
 
     def channels(self, ix):
         """self.tableの行数を引数に、ONにするビットフラグをリストで返す
@@ -219,6 +262,690 @@ class Lcbin(pd.DataFrame):
         """
         return [i for i, b in enumerate(self.array[ix], start=1) if b]
 
+    def _index(self):
+        """fkHz昇順の索引(FreqIndex)を初回だけ作成して返す"""
+        index = getattr(self, '_freq_index', None)
+        if index is None:
+            fkhz = self['fkHz'].values
+            if self._c_initial == 0 and self._c_res > 0:
+                # CpFは行番号に対して単調増加 -> fkHzは逆順に並べるだけ
+                index = FreqIndex(fkhz.__getitem__, len(self),
+                                  sorted_f=np.ascontiguousarray(fkhz[::-1]))
+            else:
+                order = np.argsort(fkhz, kind='stable')
+                index = FreqIndex(fkhz.__getitem__, len(self), order,
+                                  fkhz[order])
+            self._freq_index = index
+        return index
+
+    def nearest(self, f_khz, k: int = 1):
+        """同調周波数f_khz[kHz]に近い行をk行ずつ返す
+        f_khzに配列を渡すと、まとめて検索する
+        戻り値は目標周波数target, 行番号ix, CpF, fkHz, channelsのDataFrame
+
+        >>> bc = Lcbin(10, 4, 12.5)
+        >>> bc.nearest(300)
+           target  ix  CpF        fkHz channels
+        0   300.0   2   20  318.309886      [2]
+        >>> bc.nearest([150, 200], k=2)
+           target  ix  CpF        fkHz channels
+        0   150.0   9   90  150.052719   [1, 4]
+        1   150.0  10  100  142.352509   [2, 4]
+        2   200.0   5   50  201.316848   [1, 3]
+        3   200.0   6   60  183.776298   [2, 3]
+        """
+        index = self._index()
+        targets = np.atleast_1d(np.asarray(f_khz, dtype=float))
+        codes = index.nearest(targets, k)
+        return match_frame(targets, codes, self['CpF'].values.__getitem__,
+                           self['fkHz'].values.__getitem__, self._c_num)
+
+    def within(self, f_lo, f_hi):
+        """同調周波数がf_lo以上f_hi以下[kHz]の行をfkHz昇順で返す
+
+        >>> Lcbin(10, 4, 12.5).within(140, 160)
+            10  20  40  80  CpF        fkHz
+        10   0   1   0   1  100  142.352509
+        9    1   0   0   1   90  150.052719
+        8    0   0   0   1   80  159.154943
+        """
+        return self.iloc[self._index().within(f_lo, f_hi)]
+
+
+class VirtualLcbin:
+    """Binary Capacitance table (virtual)
+    Lcbinと同じ表を、2**c_num行を作らずに扱うクラス
+    CpF, fkHz, channels()は行番号から必要なときに計算するので、
+    メモリ使用量はc_numに比例する程度で済む。
+    要求された範囲だけをpandas.DataFrameにする。
+
+    usage:
+        `vb = VirtualLcbin(c_res=1, c_num=30, lmh=10)`
+        `vb[2**29:2**29+10]`  # 指定範囲だけDataFrameにする
+        `for df in vb.iter_chunks(2**16): ...`  # 分割して順に処理
+
+    args: Lcbinと同じ
+        dtype: ビット列のデータ型(デフォルトnp.uint8)
+
+    >>> vb = VirtualLcbin(10, 4, 12.5, dtype=int)
+    >>> len(vb)
+    16
+    >>> vb[:].equals(Lcbin(10, 4, 12.5))
+    True
+    >>> vb.head(3)
+       10  20  40  80  CpF        fkHz
+    0   0   0   0   0    0         inf
+    1   1   0   0   0   10  450.158158
+    2   0   1   0   0   20  318.309886
+    >>> vb[13:15]
+        10  20  40  80  CpF        fkHz
+    13   1   0   1   1  130  124.851409
+    14   0   1   1   1  140  120.309828
+
+    # 30チャンネル(10**9行以上)でも作成できる
+    >>> vb = VirtualLcbin(1, 30, 10)
+    >>> len(vb)
+    1073741824
+    >>> vb.channels(-1) == list(range(1, 31))
+    True
+    >>> float(vb.CpF(2**29 + 1))
+    536870913.0
+    >>> [len(df) for df in VirtualLcbin(10, 4, 12.5).iter_chunks(6)]
+    [6, 6, 4]
+    """
+
+    def __init__(
+            self,
+            c_res: float,
+            c_num: int,
+            lmh: float,
+            c_initial: float = 0,
+            c_para: float = 0,
+            c_ser: float = 0,
+            dtype=np.uint8,
+    ):
+        # Required
+        self._c_res = c_res
+        self._c_num = c_num
+        self._lmh = lmh
+        # Not required
+        self._c_initial = c_initial
+        self._c_para = c_para
+        self._c_ser = c_ser
+        self._dtype = dtype
+
+        self.columns = c_list(c_initial, c_res, c_num)
+
+    def __len__(self):
+        return 2**self._c_num
+
+    def __repr__(self):
+        return '{}(c_res={}, c_num={}, lmh={}, c_initial={}, c_para={}, '\
+            'c_ser={})'.format(type(self).__name__, self._c_res, self._c_num,
+                               self._lmh, self._c_initial, self._c_para,
+                               self._c_ser)
+
+    def __getitem__(self, key):
+        """スライスならその範囲のDataFrame、整数ならその行のSeriesを返す"""
+        if isinstance(key, slice):
+            return self.frame(np.arange(*key.indices(len(self))))
+        return self.frame([key]).iloc[0]
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def _codes(self, ix):
+        """行番号ixを0 ~ 2**c_num-1のバイナリコードに変換する
+        負の行番号は後ろから数える
+        """
+        codes = np.asarray(ix, dtype=np.int64)
+        size = len(self)
+        out_of_bounds = (codes < -size) | (codes >= size)
+        if out_of_bounds.any():
+            raise IndexError(
+                'index {} is out of bounds for axis 0 with size {}'.format(
+                    codes[out_of_bounds].flat[0], size))
+        return codes % size
+
+    def CpF(self, ix):
+        """行番号ixの合計容量[pF]"""
+        return capacitance(self._codes(ix), self._c_res, self._c_num,
+                           self._c_initial, self._c_para, self._c_ser)
+
+    def fkHz(self, ix):
+        """行番号ixの同調周波数[kHz]"""
+        with np.errstate(divide='ignore'):
+            return resonance_freq(self._lmh * 1e-3,
+                                  self.CpF(ix) * 1e-12) / 1000
+
+    def bits(self, ix):
+        """行番号ixのビット配列"""
+        return codes2bin(np.atleast_1d(self._codes(ix)), self._c_num,
+                         self._dtype)
+
+    def channels(self, ix):
+        """行番号ixを引数に、ONにするビットフラグをリストで返す
+        Lcbin.channels()と同じ
+
+        >>> vb = VirtualLcbin(100, 6, 10)
+        >>> vb.channels(6)
+        [2, 3]
+        >>> vb.channels(len(vb))
+        Traceback (most recent call last):
+        ...
+        IndexError: index 64 is out of bounds for axis 0 with size 64
+        """
+        return code2channels(self._codes(ix), self._c_num)
+
+    def frame(self, ix):
+        """行番号ix(配列)の範囲だけをLcbinと同じ列のDataFrameにする"""
+        codes = self._codes(ix)
+        df = pd.DataFrame(codes2bin(codes, self._c_num, self._dtype),
+                          index=codes,
+                          columns=self.columns,
+                          copy=False)
+        df['CpF'] = self.CpF(codes)
+        df['fkHz'] = self.fkHz(codes)
+        return df
+
+    def head(self, n: int = 5):
+        """先頭n行のDataFrame"""
+        return self[:n]
+
+    def iter_chunks(self, chunksize: int = 2**16):
+        """chunksize行ずつDataFrameを返すジェネレータ"""
+        for start in range(0, len(self), chunksize):
+            yield self[start:start + chunksize]
+
+    def to_csv(self,
+               directory=os.getcwd(),
+               sort: str = None,
+               *args,
+               fmt: str = 'csv',
+               chunksize: int = 2**16,
+               **kwargs):
+        """Lcbin.to_csv()と同じ
+        表を作らずにchunksize行ずつ計算しながら書き出す
+        """
+        return export_table(self, directory, sort, *args, fmt=fmt,
+                            chunksize=chunksize, **kwargs)
+
+    def _take(self, codes):
+        """行番号codesの行をDataFrameで返す(export_table()用)"""
+        return self.frame(codes)
+
+    def masks(self, ix):
+        """Lcbin.masks()と同じ"""
+        return self._codes(ix)
+
+    def switching_plan(self, f_khz=None, ix=None, order='nearest', start=0):
+        """Lcbin.switching_plan()と同じ"""
+        return switching_plan(self, f_khz, ix, order, start)
+
+    def to_frame(self):
+        """全行を作成してLcbinとして返す"""
+        return Lcbin(self._c_res, self._c_num, self._lmh, self._c_initial,
+                     self._c_para, self._c_ser, self._dtype)
+
+    def _index(self):
+        """fkHz昇順の索引(FreqIndex)を初回だけ作成して返す
+        c_initial=0ならCpFは行番号に対して単調なので表を作らずに検索できる。
+        そうでなければ2**c_num行分のfkHzを一度だけ計算して並べ替える。
+        """
+        index = getattr(self, '_freq_index', None)
+        if index is None:
+            if self._c_initial == 0 and self._c_res > 0:
+                index = FreqIndex(self.fkHz, len(self))
+            else:
+                fkhz = self.fkHz(np.arange(len(self)))
+                order = np.argsort(fkhz, kind='stable')
+                index = FreqIndex(self.fkHz, len(self), order, fkhz[order])
+            self._freq_index = index
+        return index
+
+    def nearest(self, f_khz, k: int = 1):
+        """同調周波数f_khz[kHz]に近い行をk行ずつ返す
+        Lcbin.nearest()と同じ
+
+        # 10**9行以上あっても表を作らずに検索する
+        >>> vn = VirtualLcbin(1, 30, 10).nearest([1, 100])
+        >>> vn.ix.tolist()
+        [2533030, 253]
+        >>> vn.channels[1]
+        [1, 3, 4, 5, 6, 7, 8]
+        """
+        targets = np.atleast_1d(np.asarray(f_khz, dtype=float))
+        codes = self._index().nearest(targets, k)
+        return match_frame(targets, codes, self.CpF, self.fkHz, self._c_num)
+
+    def within(self, f_lo, f_hi):
+        """同調周波数がf_lo以上f_hi以下[kHz]の行をfkHz昇順で返す"""
+        return self.frame(self._index().within(f_lo, f_hi))
+
+
+class FreqIndex:
+    """fkHz昇順に並べた行番号の索引
+    Lcbin.nearest(), Lcbin.within()から使う
+
+    args:
+        fkhz: 行番号の配列からfkHzを返す関数
+        size: 行数
+        order: fkHz昇順に並べた行番号の配列
+            Noneのときは行番号の降順がfkHz昇順(CpFが単調増加)とみなし、
+            配列を作らない
+        sorted_f: orderの順に並べたfkHzの配列
+            Noneのときはfkhz()を使った二分探索で検索する
+    """
+
+    def __init__(self, fkhz, size, order=None, sorted_f=None):
+        self._fkhz = fkhz
+        self._size = size
+        self._order = order
+        self._sorted_f = sorted_f
+
+    def codes(self, pos):
+        """fkHz昇順でpos番目の行番号"""
+        if self._order is None:
+            return self._size - 1 - np.asarray(pos)
+        return self._order[pos]
+
+    def searchsorted(self, targets, side='left'):
+        """np.searchsorted()と同じ位置を返す"""
+        if self._sorted_f is not None:
+            return np.searchsorted(self._sorted_f, targets, side)
+        # 二分探索をすべてのtargetsについて同時に進める
+        targets = np.asarray(targets, dtype=float)
+        lo = np.zeros(targets.shape, dtype=np.int64)
+        hi = np.full(targets.shape, self._size, dtype=np.int64)
+        while (lo < hi).any():
+            active = lo < hi
+            mid = (lo + hi) // 2
+            f = self._fkhz(self.codes(np.minimum(mid, self._size - 1)))
+            right = f < targets if side == 'left' else f <= targets
+            lo = np.where(active & right, mid + 1, lo)
+            hi = np.where(active & ~right, mid, hi)
+        return lo
+
+    def nearest(self, targets, k=1):
+        """targetsそれぞれに最も近いk行の行番号 (len(targets), k)"""
+        k = min(k, self._size)
+        pos = self.searchsorted(targets)
+        # 挿入位置の前後k個ずつが候補
+        window = np.clip(pos[:, None] + np.arange(-k, k), 0, self._size - 1)
+        codes = self.codes(window)
+        err = np.abs(self._fkhz(codes) - targets[:, None])
+        # 端でclipされて重複した候補は除く
+        err[:, 1:][np.diff(window, axis=1) == 0] = np.inf
+        best = np.argsort(err, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(codes, best, axis=1)
+
+    def within(self, f_lo, f_hi):
+        """fkHzがf_lo以上f_hi以下の行番号(fkHz昇順)"""
+        start = int(self.searchsorted(f_lo, 'left'))
+        stop = int(self.searchsorted(f_hi, 'right'))
+        return self.codes(np.arange(start, stop))
+
+
+def switching_plan(table, f_khz=None, ix=None, order='nearest', start=0):
+    """リレーの切り替え回数が少なくなる順に行を並べ、
+    各ステップでON/OFFするチャンネルを返す
+
+    args:
+        table: LcbinまたはVirtualLcbin
+        f_khz: 目標周波数[kHz]の配列 (それぞれnearest()の行に切り替える)
+        ix: 行番号の配列 (f_khzの代わりに指定する)
+        order: 切り替える順番
+            'nearest': 今の状態からON/OFFの数(ハミング距離)が
+                最も少ない行を順に選ぶ(デフォルト)
+            'gray': グレイコード順(隣り合う行番号が1ビットだけ変わる順)
+            'fkHz': 同調周波数の昇順(帯域を掃引する順)
+            None: 与えた順のまま
+        start: 切り替え前の行番号(デフォルトは全チャンネルOFF)
+
+    return: 1ステップ1行のDataFrame
+        ix: 行番号
+        fkHz: 同調周波数[kHz]
+        mask: ONにするチャンネルのビットマスク
+        on, off: そのステップでON, OFFにするチャンネル
+        toggles: そのステップで切り替えるリレーの数
+
+    >>> switching_plan(Lcbin(10, 4, 12.5))
+    Traceback (most recent call last):
+    ...
+    ValueError: give f_khz or ix
+    """
+    if f_khz is None and ix is None:
+        raise ValueError('give f_khz or ix')
+    codes = table.masks(ix) if f_khz is None else \
+        table.nearest(f_khz)['ix'].values
+    codes = np.atleast_1d(codes)
+    if order == 'nearest':
+        codes = _nearest_order(codes, start)
+    elif order == 'gray':
+        codes = codes[np.argsort(gray2bin(codes), kind='stable')]
+    elif order == 'fkHz':
+        fkhz = table._take(codes)['fkHz'].values
+        codes = codes[np.argsort(fkhz, kind='stable')]
+    elif order is not None:
+        raise ValueError('order must be nearest, gray, fkHz or None')
+
+    prev = np.append(start, codes[:-1])
+    on = codes & ~prev
+    off = prev & ~codes
+    c_num = table._c_num
+    return pd.DataFrame({
+        'ix': codes,
+        'fkHz': table._take(codes)['fkHz'].values,
+        'mask': codes,
+        'on': [code2channels(c, c_num) for c in on],
+        'off': [code2channels(c, c_num) for c in off],
+        'toggles': popcount(codes ^ prev, c_num),
+    })
+
+
+def _nearest_order(codes, start=0):
+    """startからハミング距離が最も近い行番号を順にたどる(貪欲法)"""
+    remaining = np.asarray(codes)
+    c_num = int(remaining.max()).bit_length() if len(remaining) else 0
+    c_num = max(c_num, int(start).bit_length())
+    ordered = np.empty_like(remaining)
+    current = start
+    for i in range(len(ordered)):
+        j = np.argmin(popcount(remaining ^ current, c_num))
+        ordered[i] = current = remaining[j]
+        remaining = np.delete(remaining, j)
+    return ordered
+
+
+def gray2bin(gray):
+    """グレイコードを2進数(グレイコード順の順位)に変換する
+    >>> gray2bin(np.array([0, 1, 3, 2, 6, 7, 5, 4]))
+    array([0, 1, 2, 3, 4, 5, 6, 7])
+    """
+    binary = np.array(gray, copy=True)
+    shift = 1
+    while shift < 64:
+        binary ^= binary >> shift
+        shift *= 2
+    return binary
+
+
+def bin2gray(binary):
+    """2進数をグレイコードに変換する
+    >>> bin2gray(np.arange(8))
+    array([0, 1, 3, 2, 6, 7, 5, 4])
+    """
+    binary = np.asarray(binary)
+    return binary ^ (binary >> 1)
+
+
+def code2channels(code, c_num):
+    """バイナリコードcodeでONになるチャンネル番号のリスト
+    >>> code2channels(6, 4)
+    [2, 3]
+    """
+    return [k + 1 for k in range(c_num) if (int(code) >> k) & 1]
+
+
+def match_frame(targets, codes, cpf, fkhz, c_num):
+    """nearest()の検索結果をDataFrameにする
+    targets: 目標周波数 (T,)
+    codes: 行番号 (T, k)
+    cpf, fkhz: 行番号からCpF, fkHzを返す関数
+    """
+    codes = np.asarray(codes)
+    flat = codes.ravel()
+    return pd.DataFrame({
+        'target': np.repeat(targets, codes.shape[1]),
+        'ix': flat,
+        'CpF': cpf(flat),
+        'fkHz': fkhz(flat),
+        'channels': [code2channels(c, c_num) for c in flat],
+    })
+
+
+def table_name(c_initial, c_res, c_num, lmh, ext='.csv'):
+    """パラメータからファイル名を作る
+    >>> table_name(0, 12.5, 8, 39)
+    'init0res12p5pat8l39.csv'
+    """
+    init = 'init' + str(c_initial)
+    res = 'res' + str(c_res)
+    pat = 'pat' + str(c_num)
+    lmh = 'l' + str(lmh)
+
+    # ドットをp(pointの意味)に変換(ファイルネームに.は紛らわしい)
+    name = [s.replace('.', 'p') for s in (init, res, pat, lmh)]
+    name.append(ext)
+    return ''.join(name)
+
+
+def export_table(table,
+                 directory=os.getcwd(),
+                 sort: str = None,
+                 *args,
+                 fmt: str = 'csv',
+                 chunksize: int = 2**16,
+                 **kwargs):
+    """LcbinまたはVirtualLcbinをchunksize行ずつファイルに書き出す
+    ファイル名はパラメータから自動的に決める(table_name()を参照)
+
+    args:
+        table: LcbinまたはVirtualLcbin
+        directory: 保存先ディレクトリ
+        sort: 並べ替える列名
+            'fkHz', 'CpF'は表を並べ替えずに、
+            FreqIndex(c_initial=0なら行番号の逆順)の順に行を取り出す
+            c_initial != 0のVirtualLcbinは、ONのビット数ごとの
+            行番号の列をchunksize行ずつマージする(_merged_codes())
+            その他の列はLcbinのみ指定でき、その列のargsortの順に取り出す
+        fmt: 'csv', 'npy', 'npz', 'parquet'
+            npy, npzは行番号ixとすべての列を持つ構造化配列
+            (npzは'table'という名前で圧縮して保存する)
+            parquetはpyarrowが必要
+        chunksize: 一度に書き出す行数
+        args, kwargs: fmt='csv'のときpandas.DataFrame.to_csv()に渡す
+            mode, headerは最初のchunkにだけ使い、以降はmode='a', header=False
+
+    return:
+        filename: 保存したファイル名
+    """
+    filename = os.path.join(
+        directory,
+        table_name(table._c_initial, table._c_res, table._c_num, table._lmh,
+                   '.' + fmt))
+    chunks = _export_chunks(table, sort, chunksize)
+    if fmt == 'csv':
+        mode = kwargs.pop('mode', 'w')
+        header = kwargs.pop('header', True)
+        for chunk in chunks:
+            chunk.to_csv(filename, *args, mode=mode, header=header, **kwargs)
+            mode, header = 'a', False
+    elif fmt in ('npy', 'npz'):
+        _export_npy(chunks, filename, len(table), fmt == 'npz')
+    elif fmt == 'parquet':
+        _export_parquet(chunks, filename)
+    else:
+        raise ValueError('fmt must be csv, npy, npz or parquet: ' + fmt)
+    return filename
+
+
+def _export_chunks(table, sort, chunksize):
+    """書き出す順にchunksize行ずつDataFrameを返すジェネレータ"""
+    size = len(table)
+    if sort in ('fkHz', 'CpF') and not isinstance(table, pd.DataFrame) \
+            and table._c_initial != 0 and table._c_res > 0:
+        # VirtualLcbinは全行のfkHzを並べ替えずにマージする
+        for codes in _merged_codes(table, sort == 'CpF', chunksize):
+            yield table._take(codes)
+        return
+    if sort is None:
+        order = None
+    elif sort in ('fkHz', 'CpF'):
+        index = table._index()
+        order = None
+    elif isinstance(table, pd.DataFrame):
+        order = np.argsort(table[sort].values, kind='stable')
+    else:
+        raise ValueError('sort must be fkHz or CpF: {}'.format(sort))
+    for start in range(0, size, chunksize):
+        pos = np.arange(start, min(start + chunksize, size))
+        if sort == 'fkHz':
+            codes = index.codes(pos)
+        elif sort == 'CpF':  # fkHzの降順 = CpFの昇順
+            codes = index.codes(size - 1 - pos)
+        elif order is not None:
+            codes = order[pos]
+        else:
+            codes = pos
+        yield table._take(codes)
+
+
+def _merged_codes(table, reverse, chunksize):
+    """VirtualLcbinの行番号をfkHz昇順(reverseならCpF昇順)にchunksize個ずつ返す
+    c_initial != 0のときCpF = c_para + c_res * code + c_initial * popcount
+    は行番号に対して単調ではないが、ONのビット数pが同じ行の中では単調。
+    pごとの行番号の列(組み合わせの番号から直接作る)を、
+    chunksize個ずつ読みながらマージするので、全行を並べ替えない。
+    同じfkHzの行は行番号の昇順(reverseなら降順)で、_index()の順と同じ。
+
+    >>> vb = VirtualLcbin(10, 4, 12.5, c_initial=5)
+    >>> codes = np.concatenate(list(_merged_codes(vb, False, 3)))
+    >>> codes.tolist() == vb._index().codes(np.arange(16)).tolist()
+    True
+    """
+    n = table._c_num
+    counts = [comb(n, p) for p in range(n + 1)]
+    # pごとにまだ読んでいない組み合わせの番号と、読んで残っている行
+    ranks = [0] * (n + 1)
+    buffers = [None] * (n + 1)
+    pending = []
+    npending = 0
+
+    def keys(codes):
+        # fkHz昇順: (fkHz, code)の昇順 / CpF昇順: その逆
+        f = table.fkHz(codes)
+        return (-f, -codes) if reverse else (f, codes)
+
+    while True:
+        for p in range(n + 1):
+            if (buffers[p] is None or not len(buffers[p][0])) and \
+                    ranks[p] < counts[p]:
+                stop = min(ranks[p] + chunksize, counts[p])
+                r = np.arange(ranks[p], stop)
+                # fkHz昇順ならpの中で行番号の降順に読む
+                codes = _unrank(r if reverse else counts[p] - 1 - r, n, p)
+                buffers[p] = (codes, ) + keys(codes)
+                ranks[p] = stop
+        loaded = [b for b in buffers if b is not None and len(b[0])]
+        if not loaded:
+            break
+        # まだ読んでいない行がある列の、読んだ最後の行より前は確定
+        limits = [(b[1][-1], b[2][-1]) for p, b in enumerate(buffers)
+                  if b is not None and len(b[0]) and ranks[p] < counts[p]]
+        limit = min(limits) if limits else None
+        emitted = []
+        for p, b in enumerate(buffers):
+            if b is None or not len(b[0]):
+                continue
+            codes, k1, k2 = b
+            # 各列は(k1, k2)の昇順なので、limit以下は先頭から
+            if limit is None:
+                done = len(codes)
+            else:
+                lo = np.searchsorted(k1, limit[0], 'left')
+                hi = np.searchsorted(k1, limit[0], 'right')
+                done = lo + np.searchsorted(k2[lo:hi], limit[1], 'right')
+            if done:
+                emitted.append((codes[:done], k1[:done], k2[:done]))
+                buffers[p] = (codes[done:], k1[done:], k2[done:])
+        codes, k1, k2 = (np.concatenate(x) for x in zip(*emitted))
+        pending.append(codes[np.lexsort((k2, k1))])
+        npending += len(codes)
+        while npending >= chunksize:
+            out = np.concatenate(pending)
+            yield out[:chunksize]
+            pending, npending = [out[chunksize:]], len(out) - chunksize
+    if npending:
+        yield np.concatenate(pending)
+
+
+def _unrank(ranks, n, p):
+    """ONのビット数がpのnビットの数のうち、小さい方からranks番目(配列)"""
+    ranks = np.asarray(ranks, dtype=np.int64).copy()
+    codes = np.zeros(len(ranks), dtype=np.int64)
+    left = np.full(len(ranks), p)
+    # table[bit, k] = comb(bit, k)
+    table = np.array([[comb(bit, k) for k in range(p + 1)]
+                      for bit in range(n)], dtype=np.int64)
+    for bit in range(n - 1, -1, -1):
+        # このビットが0の組み合わせの数 = comb(bit, 残りのONの数)
+        zeros = table[bit, left]
+        on = ((left > 0) & (ranks >= zeros)).astype(np.int64)
+        codes |= on << bit
+        ranks -= zeros * on
+        left -= on
+    return codes
+
+
+def _record_dtype(chunk):
+    """DataFrameの列から構造化配列のdtypeを作る(先頭は行番号ix)"""
+    fields = [('ix', np.int64)]
+    fields += [(str(c), chunk[c].dtype) for c in chunk.columns]
+    return np.dtype(fields)
+
+
+def _export_npy(chunks, filename, size, compress=False):
+    """構造化配列として.npy/.npzにchunkごとに書き出す"""
+    import zipfile
+    fp = zf = None
+    try:
+        for chunk in chunks:
+            if fp is None:
+                dtype = _record_dtype(chunk)
+                header = {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (size, ),
+                }
+                if compress:
+                    zf = zipfile.ZipFile(filename, 'w',
+                                         compression=zipfile.ZIP_DEFLATED)
+                    fp = zf.open('table.npy', 'w', force_zip64=True)
+                else:
+                    fp = open(filename, 'wb')
+                np.lib.format.write_array_header_2_0(fp, header)
+            records = np.empty(len(chunk), dtype=dtype)
+            records['ix'] = chunk.index
+            for c in chunk.columns:
+                records[str(c)] = chunk[c].values
+            fp.write(records.tobytes())
+    finally:
+        if fp is not None:
+            fp.close()
+        if zf is not None:
+            zf.close()
+
+
+def _export_parquet(chunks, filename):
+    """chunkごとにParquetのrow groupとして書き出す"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("fmt='parquet' requires pyarrow")
+    writer = None
+    try:
+        for chunk in chunks:
+            chunk = chunk.rename(columns=str).rename_axis('ix').reset_index()
+            batch = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(filename, batch.schema)
+            writer.write_table(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
 
 def dump(self):
     """print all rows & columns""" ""
@@ -242,6 +969,50 @@ def c_list(c_initial, c_res, c_num):
     return [c_initial + c_res * 2**_c for _c in range(c_num)]
 
 
+def popcount(codes, c_num):
+    """バイナリコードcodesのうち1になっているビット数を返す
+    >>> popcount(np.arange(8), 3)
+    array([0, 1, 1, 2, 1, 2, 2, 3])
+    """
+    codes = np.asarray(codes)
+    count = np.zeros(codes.shape, dtype=codes.dtype)
+    for k in range(c_num):
+        count += (codes >> k) & 1
+    return count
+
+
+def capacitance(codes, c_res, c_num, c_initial=0, c_para=0, c_ser=0):
+    """バイナリコードcodesに対する合計容量[pF]を返す
+    c_list()の各容量はc_initial + c_res * 2**kなので、
+    ビット行列を使わずに
+    c_para + c_initial * (ONのビット数) + c_res * codes
+    で計算できる。
+    c_serが0でなければ直列容量c_serとの合成容量を返す。
+
+    >>> capacitance(np.arange(4), 10, 2)
+    array([ 0, 10, 20, 30])
+    >>> capacitance(np.arange(4), 1, 2, c_initial=2)
+    array([0, 3, 4, 7])
+    >>> float(capacitance(3, 10, 2, c_ser=30))
+    15.0
+    """
+    codes = np.asarray(codes)
+    cpf = c_para + c_res * codes
+    if c_initial != 0:
+        cpf = cpf + c_initial * popcount(codes, c_num)
+    if c_ser != 0:  # Evade 0 div warning
+        cpf = 1 / ((1 / cpf) + (1 / c_ser))
+    return cpf
+
+
+def resonance_freq(l, c):
+    """同調周波数[Hz]を返す
+    l: インダクタンス[H]
+    c: キャパシタンス[F]
+    """
+    return 1 / (2 * np.pi * np.sqrt(l * c))
+
+
 def int2bin(int_i: int, zero_pad: int) -> str:
     """
     >>> int2bin(3, 4)
@@ -266,7 +1037,7 @@ def bin2int(bc_array):
     return int(joined_str, 2)  # 2進数の2
 
 
-def binary_array(c_num) -> np.ndarray:
+def binary_array(c_num, dtype=int, start=0, stop=None) -> np.ndarray:
     """Binary Capacitance table
     インダクタンス容量からコンデンサのバイナリ
     組み合わせテーブルを作成するpythonスクリプト
@@ -283,8 +1054,12 @@ def binary_array(c_num) -> np.ndarray:
         c_res: Resolution of capacitance[pf](float)
         c_num: Number of capacitance[uF](int)
         lmh: Indactance[mH](float)
+        dtype: 戻り値のデータ型(デフォルトint)
+            np.uint8を指定するとメモリが1/8になる
+        start, stop: 行番号start以上stop未満のみ作成する
+            (デフォルトは全行 0 ~ 2**c_num)
     return:
-        df: Binary table (pd.DataFrame)
+        b_array: Binary table (np.ndarray)
 
     >>> binary_array(2)
     array([[0, 0],
@@ -311,22 +1086,306 @@ def binary_array(c_num) -> np.ndarray:
     >>> n = 10
     >>> binary_array(n).shape == (2**n, n)
     True
+
+    >>> binary_array(3, np.uint8, start=5)
+    array([[1, 0, 1],
+           [0, 1, 1],
+           [1, 1, 1]], dtype=uint8)
     """
-    # ':0{}b'.format(_i, c_num) <- c_numの数だけ0-paddingし、_iを二進数に変換する
-    b_list = np.array([reversed(int2bin(_i, c_num)) for _i in range(2**c_num)])
-    # b_list like...
-    # array(['000000000000', '100000000000', '010000000000', ...,
-    # '101111111111', '011111111111', '111111111111'], dtype='<U12')
-
-    b_array = np.array([list(b) for b in b_list]).astype(int)
-    # [1:] は0のみの行排除のため
+    stop = 2**c_num if stop is None else stop
+    b_array = codes2bin(np.arange(start, stop), c_num, dtype)
     # b_array like...
-    # [[0,0,1,...],
-    # [1,0,1,...],
+    # [[0,0,0,...],
+    # [1,0,0,...],
+    # [0,1,0,...],
     # [1,1,1,...]]
     return b_array
 
 
+def codes2bin(codes, c_num, dtype=int) -> np.ndarray:
+    """行番号(バイナリコード)の配列codesをビット配列に変換する
+    列kが 2**k の桁に対応する(binary_array()と同じ並び)
+
+    >>> codes2bin([6, 1], 3)
+    array([[0, 1, 1],
+           [1, 0, 0]])
+    """
+    codes = np.asarray(codes)
+    # 行番号の各ビットを (codes >> k) & 1 で取り出して列kに書き込む
+    # 列ごとに書き込むことで行数 x c_num のint64中間配列を作らない
+    # order='F'なのでpandas.DataFrameにコピーなしで渡せる
+    b_array = np.empty((len(codes), c_num), dtype=dtype, order='F')
+    for k in range(c_num):
+        b_array[:, k] = (codes >> k) & 1
+    return b_array
+
+
+def binary_chunks(c_num, chunksize=2**16, dtype=np.uint8):
+    """binary_array()をchunksize行ずつ返すジェネレータ
+    (行番号の開始位置, ビット配列)のタプルを返す
+
+    >>> [(i, len(b)) for i, b in binary_chunks(4, 6)]
+    [(0, 6), (6, 6), (12, 4)]
+    """
+    for start in range(0, 2**c_num, chunksize):
+        stop = min(start + chunksize, 2**c_num)
+        yield start, binary_array(c_num, dtype, start, stop)
+
+
+def sweep(c_num: int,
+          lmh,
+          c_res,
+          c_initial=0,
+          c_para=0,
+          c_ser=0,
+          band=None,
+          metrics: bool = True,
+          chunksize: int = None,
+          n_jobs: int = None):
+    """Lcbinのパラメータをグリッドで振って同調周波数をまとめて計算する
+    パラメータの組み合わせごとにLcbinを作らず、
+    行番号(バイナリコード)の配列とパラメータの配列をブロードキャストして計算する
+
+    usage:
+        `sweep(8, lmh=[10, 12.5, 15], c_res=np.arange(5, 50, 5))`
+        インダクタンス3通り x 分解能9通りのまとめを返す
+
+    args:
+        c_num: Number of capacitance(int)
+        lmh, c_res, c_initial, c_para, c_ser: Lcbinと同じ
+            スカラーか1次元配列。配列を渡したパラメータの全組み合わせを計算する
+        band: (f_lo, f_hi)[kHz] 目標帯域(tuple)
+            指定するとcovered, band_gap列を追加する
+        metrics: Trueならまとめ(DataFrame)、
+            Falseなら全行のfkHz配列(np.ndarray)を返す
+        chunksize: 一度に計算するパラメータの組み合わせ数
+            (デフォルトは1チャンクあたり約4M要素)
+        n_jobs: 指定するとプロセスプールでチャンクを並列計算する
+
+    return:
+        metrics=True: パラメータの組み合わせごとに1行のDataFrame
+            fmin, fmax: 最低, 最高同調周波数[kHz]
+            max_gap: 隣り合う同調周波数の最大間隔[kHz]
+            covered: bandをfmin~fmaxで覆っているか
+            band_gap: band内で同調できない最大の幅[kHz]
+        metrics=False: fkHz配列
+            shape = (配列を渡したパラメータの長さ..., 2**c_num)
+            パラメータの並びはlmh, c_res, c_initial, c_para, c_ser
+
+    >>> f = sweep(4, 12.5, [10, 20], metrics=False)
+    >>> f.shape
+    (2, 16)
+    >>> np.allclose(f[1], Lcbin(20, 4, 12.5).fkHz)
+    True
+    >>> df = sweep(4, [10, 12.5], 10, band=(120, 300))
+    >>> df[['lmh', 'fmin', 'fmax', 'max_gap', 'covered', 'band_gap']]
+        lmh        fmin        fmax     max_gap  covered   band_gap
+    0  10.0  129.949467  503.292121  147.410849    False  38.929781
+    1  12.5  116.230337  450.158158  131.848272     True  40.101066
+    """
+    params = [lmh, c_res, c_initial, c_para, c_ser]
+    grid = np.meshgrid(*[np.atleast_1d(p) for p in params], indexing='ij')
+    shape = [len(np.atleast_1d(p)) for p in params if np.ndim(p) > 0]
+    table = np.column_stack([g.ravel() for g in grid])
+    if chunksize is None:
+        chunksize = max(1, 2**22 // 2**c_num)
+    chunks = [
+        table[i:i + chunksize] for i in range(0, len(table), chunksize)
+    ]
+    args = [(chunk, c_num, band, metrics) for chunk in chunks]
+    if n_jobs:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(n_jobs) as executor:
+            results = list(executor.map(_sweep_chunk, *zip(*args)))
+    else:
+        results = [_sweep_chunk(*arg) for arg in args]
+
+    if not metrics:
+        return np.concatenate(results).reshape(*shape, 2**c_num)
+    df = pd.DataFrame(table,
+                      columns=['lmh', 'c_res', 'c_initial', 'c_para', 'c_ser'])
+    df = df.astype({k: np.asarray(p).dtype
+                    for k, p in zip(df.columns, params)})
+    summary = pd.concat(results, ignore_index=True)
+    return pd.concat([df, summary], axis=1)
+
+
+def _sweep_chunk(table, c_num, band=None, metrics=True):
+    """sweep()の1チャンク分を計算する
+    table: lmh, c_res, c_initial, c_para, c_serを列に持つ配列
+    プロセスプールから呼ぶのでモジュールレベルに置く
+    """
+    lmh, c_res, c_initial, c_para, c_ser = (col[:, None] for col in table.T)
+    codes = np.arange(2**c_num)
+    cpf = c_para + c_res * codes
+    if (c_initial != 0).any():
+        cpf = cpf + c_initial * popcount(codes, c_num)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cpf = np.where(c_ser != 0,
+                       1 / ((1 / cpf) + (1 / np.where(c_ser != 0, c_ser, 1))),
+                       cpf)
+        fkhz = resonance_freq(lmh * 1e-3, cpf * 1e-12) / 1000
+    if not metrics:
+        return fkhz
+
+    # 同調しない行(CpF=0)は除いて昇順に並べる
+    fkhz = np.where(np.isfinite(fkhz), fkhz, np.nan)
+    if (c_initial == 0).all() and (c_res > 0).all():
+        fkhz = fkhz[:, ::-1]  # CpFが単調増加なので逆順が昇順
+    else:
+        fkhz = np.sort(fkhz, axis=1)  # nanは末尾に並ぶ
+    fmin = np.nanmin(fkhz, axis=1)
+    fmax = np.nanmax(fkhz, axis=1)
+    filled = np.where(np.isnan(fkhz), fmax[:, None], fkhz)
+    summary = pd.DataFrame({
+        'fmin': fmin,
+        'fmax': fmax,
+        'max_gap': np.diff(filled, axis=1).max(axis=1),
+    })
+    if band is not None:
+        f_lo, f_hi = band
+        # 帯域内に切り詰めて帯域の両端を加えると、
+        # 隣り合う差が帯域内で同調できない幅になる
+        clipped = np.where(np.isnan(fkhz), f_hi, np.clip(fkhz, f_lo, f_hi))
+        edges = np.column_stack([
+            np.full(len(fkhz), f_lo), clipped, np.full(len(fkhz), f_hi)
+        ])
+        summary['covered'] = (fmin <= f_lo) & (fmax >= f_hi)
+        summary['band_gap'] = np.diff(edges, axis=1).max(axis=1)
+    return summary
+
+
+def tolerance_mc(c_res: float,
+                 c_num: int,
+                 lmh: float,
+                 c_initial: float = 0,
+                 c_para: float = 0,
+                 c_ser: float = 0,
+                 c_tol: float = 0.05,
+                 l_tol: float = 0,
+                 n: int = 10000,
+                 dist: str = 'uniform',
+                 gap_ratio: float = 2.0,
+                 seed=None,
+                 chunksize: int = None,
+                 dtype=np.float32,
+                 n_jobs: int = None):
+    """コンデンサ(とインダクタンス)の誤差によるfkHzのばらつきを
+    モンテカルロ法で計算する
+    c_list()の各チャンネルの容量とlmhをn回ずつ乱数で振り、
+    すべてのバイナリコードの同調周波数を計算する
+
+    usage:
+        `tolerance_mc(10, 12, 12.5, c_tol=0.05, n=10000, n_jobs=4)`
+
+    args:
+        c_res, c_num, lmh, c_initial, c_para, c_ser: Lcbinと同じ
+        c_tol: コンデンサの誤差(0.05なら±5%)
+        l_tol: インダクタンスの誤差
+        n: サンプル数
+        dist: 'uniform'なら±tolの一様分布、
+            'normal'ならtolを3σとする正規分布
+        gap_ratio: 隣の行との間隔が公称値のgap_ratio倍を超えたら"すき間"とする
+        seed: 乱数シード(n_jobsによらず同じ結果になる)
+        chunksize: 一度に計算するサンプル数
+            (デフォルトは1チャンクあたり約4M要素)
+        dtype: 計算に使うデータ型(デフォルトnp.float32)
+        n_jobs: 指定するとプロセスプールでチャンクを並列計算する
+
+    return: 公称fkHz昇順に並べたDataFrame(indexは行番号ix)
+        fkHz: 公称の同調周波数[kHz]
+        mean, std, min, max: サンプルの同調周波数[kHz]
+        p_overlap: 次の行(1つ上の公称周波数)と順序が入れ替わる確率
+        p_gap: 次の行との間隔が公称値のgap_ratio倍を超える確率
+
+    >>> mc = tolerance_mc(10, 4, 12.5, c_tol=0.01, n=1000, seed=0)
+    >>> mc.index[:3].tolist()
+    [15, 14, 13]
+    >>> np.allclose(mc.fkHz, Lcbin(10, 4, 12.5).fkHz[mc.index])
+    True
+    >>> bool((abs(mc['mean'] / mc.fkHz - 1) < 0.01).all())
+    True
+    >>> float(mc.p_overlap.max())
+    0.0
+    >>> float(tolerance_mc(10, 4, 12.5, c_tol=0.2, n=1000, seed=0).p_overlap.max()) > 0
+    True
+    """
+    size = 2**c_num
+    cpf = capacitance(np.arange(size), c_res, c_num, c_initial, c_para, c_ser)
+    with np.errstate(divide='ignore'):
+        nominal = resonance_freq(lmh * 1e-3, cpf * 1e-12) / 1000
+    # 同調しない行(CpF=0)は除き、公称fkHz昇順に並べる
+    codes = np.flatnonzero(np.isfinite(nominal))
+    codes = codes[np.argsort(nominal[codes], kind='stable')]
+
+    if chunksize is None:
+        chunksize = max(1, 2**22 // len(codes))
+    sizes = [min(chunksize, n - i) for i in range(0, n, chunksize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    gap_limit = gap_ratio * np.diff(nominal[codes])
+    args = [(codes, c_list(c_initial, c_res, c_num), lmh, c_para, c_ser,
+             c_tol, l_tol, m, dist, gap_limit, s, dtype)
+            for m, s in zip(sizes, seeds)]
+    if n_jobs:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(n_jobs) as executor:
+            results = list(executor.map(_mc_chunk, *zip(*args)))
+    else:
+        results = [_mc_chunk(*arg) for arg in args]
+
+    total = {k: np.sum([r[k] for r in results], axis=0)
+             for k in ('sum', 'sumsq', 'overlap', 'gap')}
+    mean = total['sum'] / n
+    df = pd.DataFrame(
+        {
+            'fkHz': nominal[codes],
+            'mean': mean,
+            'std': np.sqrt(np.maximum(total['sumsq'] / n - mean**2, 0)),
+            'min': np.min([r['min'] for r in results], axis=0),
+            'max': np.max([r['max'] for r in results], axis=0),
+            'p_overlap': np.append(total['overlap'] / n, np.nan),
+            'p_gap': np.append(total['gap'] / n, np.nan),
+        },
+        index=pd.Index(codes, name='ix'))
+    return df
+
+
+def _mc_chunk(codes, c_nominal, lmh, c_para, c_ser, c_tol, l_tol, n, dist,
+              gap_limit, seed, dtype):
+    """tolerance_mc()のサンプルn個分を計算して集計値を返す
+    gap_limit: 隣の行との間隔の上限[kHz] (len(codes)-1,)
+    プロセスプールから呼ぶのでモジュールレベルに置く
+    """
+    rng = np.random.default_rng(seed)
+    c_num = len(c_nominal)
+
+    def deviation(size, tol):
+        if dist == 'normal':
+            return 1 + rng.normal(0, tol / 3, size).astype(dtype)
+        return 1 + rng.uniform(-tol, tol, size).astype(dtype)
+
+    c_samples = np.asarray(c_nominal, dtype=dtype) * deviation((n, c_num),
+                                                               c_tol)
+    l_samples = dtype(lmh) * deviation(n, l_tol)
+    bits = codes2bin(codes, c_num, dtype)
+    # (行数, サンプル数)
+    cpf = dtype(c_para) + bits @ c_samples.T
+    if c_ser != 0:
+        cpf = 1 / ((1 / cpf) + dtype(1 / c_ser))
+    fkhz = 1 / (2 * np.pi * np.sqrt(l_samples * 1e-3 * cpf * 1e-12)) / 1000
+    fkhz = fkhz.astype(dtype, copy=False)
+
+    step = np.diff(fkhz, axis=0)
+    return {
+        'sum': fkhz.sum(axis=1, dtype=np.float64),
+        'sumsq': np.square(fkhz, dtype=np.float64).sum(axis=1),
+        'min': fkhz.min(axis=1),
+        'max': fkhz.max(axis=1),
+        'overlap': (step <= 0).sum(axis=1),
+        'gap': (step > gap_limit[:, None]).sum(axis=1),
+    }
+
+
 def main(argv):
     """call from shell function"""
     if len(argv) > 1:
@@ -4,13 +4,132 @@ import sys
 import pandas as pd
 import numpy as np
 from .csv_reader import reader_N5071
+from .dbmw import db2mw
+from .dbmw import mw2db
 
 
 def nearest_x(series, value):
-    """valueに最も近い値下がったところのindexを返す"""
-    down = series.max() - value
-    absolute_sub = pd.Series(abs(series - down)).sort_values()
-    return absolute_sub
+    """valueに最も近い値下がったところのindexを返す
+    全体をソートせずにargminで探し、
+    index=そのindex, 値=最大値-valueとの差の長さ1のSeriesを返す
+    (`.index[0]`, `.values[0]`で使う)
+    seriesにnp.ndarrayを渡すとindexは位置
+
+    >>> s = pd.Series([0, 5, 9, 10, 8, 2], index=[10, 20, 30, 40, 50, 60])
+    >>> nearest_x(s, 3)
+    50    1.0
+    dtype: float64
+    >>> nearest_x(s.values, 3).index.tolist()
+    [4]
+    """
+    values = np.asarray(series, dtype=float)
+    absolute_sub = np.abs(values - (np.nanmax(values) - value))
+    i = int(np.nanargmin(absolute_sub))
+    index = series.index[i:i + 1] if isinstance(series, pd.Series) else [i]
+    return pd.Series(absolute_sub[i:i + 1], index=index)
+
+
+def crossings(data, levels=(3, 6, 10, 20)) -> pd.DataFrame:
+    """最大値からlevels[dB]落ちの周波数を、低域f1と高域f2についてまとめて返す
+    Syncfと同じく、最大値の位置で前後に分けて、
+    それぞれ最大値-levelに最も近い点を選ぶ。
+    すべてのlevelを1回の2次元配列の計算で探す
+
+    args:
+        data: F特(pd.Series, np.ndarrayならindexは位置)
+        levels: 落ちる量[dB]のリスト
+
+    return: index=levelのDataFrame
+        f1, f2: 低域, 高域の周波数
+        BW: f2 - f1
+        score_f1, score_f2: Syncf.score()と同じ(1 - 最も近い点との差)
+
+    >>> s = pd.Series([0, 5, 9, 10, 8, 2], index=[10, 20, 30, 40, 50, 60])
+    >>> cr = crossings(s, [1, 5])
+    >>> cr['f1'].tolist(), cr['f2'].tolist(), cr['BW'].tolist()
+    ([30, 20], [50, 60], [20, 40])
+    """
+    values = np.asarray(data, dtype=float)
+    index = data.index if isinstance(data, pd.Series) else np.arange(
+        len(values))
+    levels = pd.Index(np.atleast_1d(levels), name='level')
+    thresholds = np.asarray(levels, dtype=float)
+    peak = int(np.nanargmax(values))
+    result = {}
+    for name, half, offset in (('f1', values[:peak + 1], 0),
+                               ('f2', values[peak + 1:], peak + 1)):
+        # 行が点、列がlevelの差
+        diff = np.abs(half[:, None] - (np.nanmax(half) - thresholds))
+        pos = np.nanargmin(diff, axis=0)
+        result[name] = np.asarray(index[pos + offset])
+        result['score_' + name] = 1 - diff[pos, np.arange(len(levels))]
+    df = pd.DataFrame(result, index=levels)
+    df.insert(2, 'BW', df['f2'] - df['f1'])
+    return df[['f1', 'f2', 'BW', 'score_f1', 'score_f2']]
+
+
+def interp_crossings(x, y, level: float = 3, kind: str = 'linear',
+                     peak: int = None):
+    """最大値からlevel[dB]落ちの周波数を、点の間を補間して求める
+    最大値に最も近い、levelを横切る前後2点の間で補間する
+
+    kind:
+        'linear': 標本の最大値を基準に、前後2点の線形補間
+        'quadratic': 最大値を前後3点の放物線の頂点で補正し、
+            横切る2点ともう1点の放物線で補間
+    peak: 最大値の位置(省略するとnp.nanargmax(y))
+
+    return: (f1, f2, fmax) 横切らなければ端の周波数
+
+    >>> x = np.array([0., 1, 2, 3, 4])
+    >>> y = np.array([0., 4, 8, 4, 0])
+    >>> interp_crossings(x, y, 2, 'linear')
+    (1.5, 2.5, 2.0)
+    """
+    peak = int(np.nanargmax(y)) if peak is None else peak
+    fmax, top = x[peak], y[peak]
+    if kind == 'quadratic' and 0 < peak < len(y) - 1:
+        fmax, top = _vertex(x[peak - 1:peak + 2], y[peak - 1:peak + 2], fmax,
+                            top)
+    thr = top - level
+    below = np.flatnonzero(y[:peak] < thr)
+    # 低域: 最大値に最も近い y[i] < thr <= y[i+1]
+    f1 = x[0] if len(below) == 0 else _crossing(x, y, thr, below[-1], kind)
+    below = np.flatnonzero(y[peak + 1:] < thr) + peak + 1
+    # 高域: 最大値に最も近い y[j-1] >= thr > y[j]
+    f2 = x[-1] if len(below) == 0 else _crossing(x, y, thr, below[0] - 1,
+                                                 kind)
+    return float(f1), float(f2), float(fmax)
+
+
+def _vertex(x3, y3, fmax, top):
+    """3点を通る放物線の頂点 上に凸でなければ(fmax, top)のまま"""
+    x0 = x3[1]
+    a, b, c = np.polyfit(x3 - x0, y3, 2)
+    if a >= 0:
+        return fmax, top
+    return x0 - b / (2 * a), c - b**2 / (4 * a)
+
+
+def _crossing(x, y, thr, i, kind):
+    """y[i]とy[i+1]の間でthrを横切るx"""
+    linear = x[i] + (thr - y[i]) * (x[i + 1] - x[i]) / (y[i + 1] - y[i])
+    if kind == 'linear' or len(x) < 3:
+        return linear
+    # 横切る2点に、最大値から遠い側の1点を加える(端なら反対側)
+    j = i - 1 if (y[i] < y[i + 1]) == (i > 0) else i + 2
+    j = min(max(j, 0), len(x) - 1)
+    idx = np.sort([i, i + 1, j])
+    if len(set(idx.tolist())) < 3:
+        return linear
+    x0 = x[i]
+    a, b, c = np.polyfit(x[idx] - x0, y[idx], 2)
+    if a == 0:
+        return linear
+    roots = np.roots([a, b, c - thr])
+    roots = roots[np.isreal(roots)].real + x0
+    inside = roots[(roots >= x[i]) & (roots <= x[i + 1])]
+    return inside[0] if len(inside) else linear
 
 
 class Syncf:
@@ -27,6 +146,12 @@ class Syncf:
 
     args:
         data: Network Analyzerから読んだF特(pandas.Series型)
+        interp: 3dB落ちの周波数の求め方
+            None: 最も近い点の周波数(デフォルト)
+            'linear': 前後の点の線形補間
+            'quadratic': 最大値を放物線で補正し、3点の2次補間
+            'linear', 'quadratic'では、両者の差を不確かさとして
+            f1_err, f2_err, q_errに入れる
 
     return
         f1: 3dB落ちの周波数(低域)
@@ -38,28 +163,57 @@ class Syncf:
         a: 1Hzあたりの減衰[dB]
     """
 
-    def __init__(self, data, f1=None, f2=None):
+    def __init__(self, data, f1=None, f2=None, interp=None):
         self.data = data
+        self.interp = interp
 
-        lower = data.loc[data.index <= data.idxmax()]
-        upper = data.loc[data.index > data.idxmax()]
+        # 最大値の位置で前後に分ける(マスクでコピーしない)
+        peak = int(np.nanargmax(np.asarray(data, dtype=float)))
+        lower = data.iloc[:peak + 1]
+        upper = data.iloc[peak + 1:]
 
         self._lower3dBdown = nearest_x(lower, 3)
         self._upper3dBdown = nearest_x(upper, 3)
 
-        self.f1 = f1 if f1 else self._lower3dBdown.index[0]
-        self.f2 = f2 if f2 else self._upper3dBdown.index[0]
+        if interp is None:
+            f1_, f2_ = self._lower3dBdown.index[0], self._upper3dBdown.index[0]
+            self.fmax = data.index[peak]
+        else:
+            x = np.asarray(data.index, dtype=float)
+            y = np.asarray(data, dtype=float)
+            found = {
+                kind: interp_crossings(x, y, 3, kind, peak)
+                for kind in ('linear', 'quadratic')
+            }
+            if interp not in found:
+                raise ValueError(
+                    "interp must be None, 'linear' or 'quadratic'")
+            f1_, f2_, self.fmax = found[interp]
+            # 補間方法による差を不確かさとする
+            self.f1_err, self.f2_err, _ = np.abs(
+                np.subtract(found['quadratic'], found['linear']))
+        self.f1 = f1 if f1 else f1_
+        self.f2 = f2 if f2 else f2_
 
         self.f0 = np.mean([self.f1, self.f2])
-        self.fmax = self.data.idxmax()
 
         self.bw = self.f2 - self.f1
         self.q = self.f0 / self.bw
+        if interp is not None:
+            bw_err = np.hypot(self.f1_err, self.f2_err)
+            self.q_err = self.q * np.hypot(bw_err / 2 / self.f0,
+                                           bw_err / self.bw)
 
         # 線形フィットで傾きaをだす
         curv = self.data.loc[self.f1:self.fmax]
         self.a, self._b = np.polyfit(curv.index, curv.values, 1)
 
+    @classmethod
+    def from_frame(cls, df, chunksize: int = 256) -> pd.DataFrame:
+        """dfの全列についてのdescribe()とscore()をまとめたDataFrame
+        `describe_many(df, chunksize)`と同じ"""
+        return describe_many(df, chunksize)
+
     def score(self):
         """ずれ幅
         1が一番よい値。0が一番悪い値です。
@@ -81,6 +235,7 @@ class Syncf:
         BW; f2-f1
         Q: f0 / BW
         a: -a[dB] / Hz
+        f1_err, f2_err, Q_err: interpを指定したときの不確かさ
         """
         dicc = {
             'f1': self.f1,
@@ -91,20 +246,238 @@ class Syncf:
             'Q': self.q,
             'a': self.a,
         }
+        if self.interp is not None:
+            dicc.update(f1_err=self.f1_err,
+                        f2_err=self.f2_err,
+                        Q_err=self.q_err)
         return pd.Series(dicc, index=dicc.keys())
 
     def plot(self, ylabel='試験入力利得[dB]', **kwargs):
         """Return plot and point of f1~f2"""
         ax = self.data.plot(**kwargs)
         ax.set_ylabel(ylabel)
-        ax.plot([self.f1, self.f2, self.fmax],
-                [self.data[self.f1], self.data[self.f2], self.data[self.fmax]],
-                'd')
+        points = [self.f1, self.f2, self.fmax]
+        # 補間した周波数はインデックスの中にない場合がある
+        ax.plot(points,
+                np.interp(points, self.data.index, self.data.values), 'd')
         # ax.plot(self.f0, self.data[self.f0], 'd')
         # 帯域から導いたf0はインデックスの中にない場合がある
         return ax
 
 
+def describe_many(df, chunksize: int = 256) -> pd.DataFrame:
+    """dfの各列(F特)についてSyncfのdescribe()とscore()をまとめて計算する
+    列ごとにSyncfを作る代わりに、chunksize列ずつ2次元配列で計算する
+    傾きaは列ごとの最小二乗法の閉じた式で求める
+
+    return: index=dfの列のDataFrame
+        f1, f2, f0, fmax, BW, Q, a: Syncf.describe()と同じ
+        score_f1, score_f2: Syncf.score()と同じ
+        最大値が最後の行で高域側がない列(Syncfではエラーになる列)は
+        f2, f0, BW, Q, a, score_f1, score_f2をNaNにする
+
+    >>> f = np.linspace(100, 200, 101)
+    >>> df = pd.DataFrame({q: -10 * np.log10(1 + (q * (f / 150 - 150 / f))**2)
+    ...                    for q in (10, 20)}, index=f)
+    >>> describe_many(df)[['f1', 'f2', 'Q']].round(1)
+           f1     f2     Q
+    10  143.0  158.0  10.0
+    20  146.0  154.0  18.8
+    >>> df['edge'] = f / 10  # 最大値が最後の行
+    >>> describe_many(df).loc['edge', ['f2', 'BW', 'Q', 'score_f2']].tolist()
+    [nan, nan, nan, nan]
+    """
+    x = np.asarray(df.index, dtype=float)
+    # 傾きの桁落ちを防ぐため中心化する
+    x_c = x - x.mean() if len(x) else x
+    rows = np.arange(len(x))[:, None]
+    parts = []
+    for start in range(0, df.shape[1], chunksize):
+        y = np.asarray(df.iloc[:, start:start + chunksize], dtype=float)
+        cols = np.arange(y.shape[1])
+        peak = np.nanargmax(y, axis=0)
+        lower = rows <= peak
+        with np.errstate(invalid='ignore'):
+            # Syncfと同じく、高域側は最大値の次の点からの最大値を使う
+            upper_max = np.nanmax(np.where(lower, -np.inf, y), axis=0)
+            down = np.abs(y - (np.where(lower, y[peak, cols], upper_max) - 3))
+        down = np.where(np.isnan(down), np.inf, down)
+        i1 = np.argmin(np.where(lower, down, np.inf), axis=0)
+        i2 = np.argmin(np.where(lower, np.inf, down), axis=0)
+        f1, f2, fmax = x[i1], x[i2], x[peak]
+        # 最大値より後ろに値がない列
+        edge = np.isneginf(upper_max)
+        f2 = np.where(edge, np.nan, f2)
+        # f1~fmaxの最小二乗の傾き
+        m = (rows >= i1) & lower & ~np.isnan(y)
+        n = m.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mx = (m * x_c[:, None]).sum(axis=0) / n
+            my = np.where(m, y, 0).sum(axis=0) / n
+            dx = np.where(m, x_c[:, None] - mx, 0)
+            a = (dx * np.where(m, y - my, 0)).sum(axis=0) / (dx**2).sum(
+                axis=0)
+        a = np.where(edge, np.nan, a)
+        scores = np.where(edge, np.nan, 1 - down[[i1, i2], cols])
+        parts.append(
+            pd.DataFrame(
+                {
+                    'f1': f1,
+                    'f2': f2,
+                    'f0': (f1 + f2) / 2,
+                    'fmax': fmax,
+                    'BW': f2 - f1,
+                    'Q': (f1 + f2) / 2 / (f2 - f1),
+                    'a': a,
+                    'score_f1': scores[0],
+                    'score_f2': scores[1],
+                },
+                index=df.columns[start:start + chunksize]))
+    return pd.concat(parts) if parts else pd.DataFrame(
+        columns=['f1', 'f2', 'f0', 'fmax', 'BW', 'Q', 'a', 'score_f1',
+                 'score_f2'])
+
+
+def fit_lorentzian(df,
+                   chunksize: int = 1024,
+                   max_iter: int = 100,
+                   tol: float = 1e-10,
+                   n_jobs: int = None,
+                   residuals: bool = False):
+    """dfの各列(F特[dB])に共振曲線をまとめてフィットする
+    リニアの電力(db2mw)で P(f) = A / (1 + Q**2 * (f/f0 - f0/f)**2)
+    をLevenberg-Marquardt法で、chunksize列ずつ2次元配列でフィットする
+    初期値はdescribe_many()のf0, Qと最大値
+
+    args:
+        df: 行が周波数、列がtraceのDataFrame[dB]
+        chunksize: 一度に計算する列数
+        max_iter: 最大反復回数
+        tol: 残差二乗和かパラメータの相対変化がtol未満で収束とみなす
+        n_jobs: 指定するとchunkをプロセスプールで計算する
+        residuals: Trueなら(結果, 残差[dB]のDataFrame)を返す
+
+    return: index=dfの列のDataFrame
+        f0: 同調周波数
+        Q: Q値
+        gain: ピークの利得[dB] (mw2db(A))
+        rms: 残差(データ - モデル)[dB]の二乗平均平方根
+        converged: 収束したか
+
+    >>> f = np.linspace(100, 200, 201)
+    >>> df = pd.DataFrame({
+    ...     q: -20 - 10 * np.log10(1 + (q * (f / 150 - 150 / f))**2)
+    ...     for q in (10, 30)}, index=f)
+    >>> fit_lorentzian(df)[['f0', 'Q', 'gain']].round(6)
+           f0     Q  gain
+    10  150.0  10.0 -20.0
+    30  150.0  30.0 -20.0
+    """
+    x = np.asarray(df.index, dtype=float)
+    init = describe_many(df, chunksize)
+    y = np.asarray(df, dtype=float)
+    p0 = np.column_stack([
+        db2mw(np.nanmax(y, axis=0)),
+        np.where(np.isfinite(init['f0']), init['f0'], init['fmax']),
+        np.where(np.isfinite(init['Q']) & (init['Q'] > 0), init['Q'], 1.0)
+    ])
+    chunks = [(x, y[:, i:i + chunksize], p0[i:i + chunksize], max_iter, tol)
+              for i in range(0, y.shape[1], chunksize)]
+    if n_jobs:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(n_jobs) as executor:
+            fitted = list(executor.map(_fit_chunk, *zip(*chunks)))
+    else:
+        fitted = [_fit_chunk(*chunk) for chunk in chunks]
+    params = np.concatenate([f[0] for f in fitted]) if fitted else p0
+    converged = np.concatenate([f[1] for f in fitted]) if fitted else []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        resid = y - mw2db(_lorentzian(x[:, None], *params.T))
+    result = pd.DataFrame(
+        {
+            'f0': params[:, 1],
+            'Q': np.abs(params[:, 2]),
+            'gain': mw2db(params[:, 0]),
+            'rms': np.sqrt(np.nanmean(resid**2, axis=0)),
+            'converged': converged,
+        },
+        index=df.columns)
+    if residuals:
+        return result, pd.DataFrame(resid, index=df.index, columns=df.columns)
+    return result
+
+
+def _lorentzian(f, a, f0, q):
+    """リニアの電力の共振曲線"""
+    u = f / f0 - f0 / f
+    return a / (1 + q**2 * u**2)
+
+
+def _fit_chunk(x, y_db, p0, max_iter, tol):
+    """fit_lorentzian()の1chunk分のLevenberg-Marquardt法
+    列ごとに減衰係数lamを持ち、残差が減った列だけ更新する
+    収束した列は次の反復から計算しない
+    return: (params(shape=(列数, 3)), converged)"""
+    # 列を行にして、計算中の列を連続したメモリで取り出す
+    f = x[None, :]
+    y_all = db2mw(np.ascontiguousarray(y_db.T))
+    valid_all = ~np.isnan(y_all)
+    y_all = np.where(valid_all, y_all, 0)
+    p_all = p0.astype(float)
+    converged = np.zeros(len(p_all), dtype=bool)
+    active = np.arange(len(p_all))
+    lam = np.full(len(p_all), 1e-3)
+
+    def residual(p, y, valid):
+        return np.where(valid, y - _lorentzian(f, *p.T[..., None]), 0)
+
+    r_all = residual(p_all, y_all, valid_all)
+    cost = (r_all**2).sum(axis=1)
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        p, y, valid = p_all[active], y_all[active], valid_all[active]
+        r = r_all[active]
+        a, f0, q = p.T[..., None]
+        u = f / f0 - f0 / f
+        d = 1 + q**2 * u**2
+        g = valid * a / d**2
+        # ヤコビアンの列(列, 点)
+        jac = [valid / d, g * q**2 * 2 * u * (f / f0**2 + 1 / f),
+               -g * 2 * q * u**2]
+        jtj = np.empty((len(active), 3, 3))
+        for i in range(3):
+            for j in range(i, 3):
+                jtj[:, i, j] = jtj[:, j, i] = (jac[i] * jac[j]).sum(axis=1)
+        jtr = np.stack([(jac_i * r).sum(axis=1) for jac_i in jac], axis=-1)
+        damped = jtj.copy()
+        damped[:, range(3), range(3)] *= 1 + lam[active, None]
+        try:
+            step = np.linalg.solve(damped, jtr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            # 特異な列があるときは擬似逆行列で
+            step = np.nan_to_num(
+                np.einsum('kij,kj->ki', np.linalg.pinv(damped), jtr))
+        trial = p + step
+        new_r = residual(trial, y, valid)
+        new_cost = (new_r**2).sum(axis=1)
+        old_cost = cost[active]
+        better = np.isfinite(new_cost) & (new_cost < old_cost)
+        # 残差二乗和かパラメータの相対変化がtol未満なら収束
+        small = (np.abs(step) <= tol * np.abs(p)).all(axis=1)
+        done = small | (old_cost == 0) | (
+            better & (old_cost - new_cost <= tol * old_cost))
+        idx = active[better]
+        p_all[idx] = trial[better]
+        r_all[idx] = new_r[better]
+        cost[idx] = new_cost[better]
+        lam[active] = np.where(better, lam[active] / 10,
+                               np.minimum(lam[active] * 10, 1e16))
+        converged[active[done]] = True
+        active = active[~done]
+    return p_all, converged
+
+
 def main(argvs):
     """from shell session
     $ python sana.py test.csv
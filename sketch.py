@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""ノイズフロア(分位点)を少しずつ読みながら求める
+
+dbmw.noisefloorやdescribe_SNはtrace全体をメモリに読んでから
+25パーセンタイルをとる。QuantileSketchは固定幅のビンのヒストグラムに
+値を数えるだけなので、使うメモリはデータ数によらず、
+別々のプロセスで作ったスケッチは足し合わせる(merge)だけでまとめられる。
+分位点の誤差はビン幅の半分(error)以下。
+
+usage:
+    # 大きなCSVを10万行ずつ読んで、列ごとのノイズフロア
+    streaming_noisefloor(iter_rows('data/*.csv', chunksize=100000))
+
+    # S/Nも1回読むだけで
+    streaming_describe_SN(iter_rows('data/*.csv'), freq=[120, 150])
+
+    # プロセスごとのスケッチをまとめる
+    sketches = executor.map(make_sketch, parts)
+    sum(sketches[1:], sketches[0]).quantile(25)
+"""
+import warnings
+import numpy as np
+import pandas as pd
+from .describe_SN import _sn_frame
+from .describe_SN import _window_mean
+from .describe_SN import _window_sums
+
+
+class QuantileSketch:
+    """n個の分布の分位点を近似する、足し合わせられるヒストグラム
+
+    args:
+        n: 分布の数(列数)
+        error: 分位点の許容誤差[dB] (ビン幅はerror*2)
+        lo, hi: ビンの範囲[dB]
+            範囲外の値は端のビンに数える(その分布の誤差は保証しない)
+
+    >>> rng = np.random.default_rng(0)
+    >>> x = rng.normal(-80, 5, (10000, 2))
+    >>> a, b = QuantileSketch(2), QuantileSketch(2)
+    >>> a.update(x[:6000])
+    >>> b.update(x[6000:])
+    >>> err = (a + b).quantile(25) - np.percentile(x, 25, axis=0)
+    >>> bool((np.abs(err) <= 0.05).all())
+    True
+    """
+
+    def __init__(self,
+                 n: int = 1,
+                 error: float = 0.05,
+                 lo: float = -200.,
+                 hi: float = 50.):
+        self.n = n
+        self.error = error
+        self.lo = lo
+        self.hi = hi
+        self.width = error * 2
+        self.nbins = int(np.ceil((hi - lo) / self.width))
+        self.counts = np.zeros((n, self.nbins), dtype=np.int64)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        self.outside = np.zeros(n, dtype=np.int64)
+
+    def __repr__(self):
+        return 'QuantileSketch(n={}, error={}, lo={}, hi={})'.format(
+            self.n, self.error, self.lo, self.hi)
+
+    @property
+    def count(self) -> np.ndarray:
+        """分布ごとの値の数(NaNを除く)"""
+        return self.counts.sum(axis=1)
+
+    def update(self, values):
+        """values(shape=(値の数, n))を数える。NaNは数えない"""
+        values = np.asarray(values, dtype=float).reshape(-1, self.n)
+        size = self.counts.size
+        top = self.lo + self.nbins * self.width
+        with np.errstate(invalid='ignore'):
+            self.outside += ((values < self.lo) |
+                             (values >= top)).sum(axis=0)
+            self.min = np.fmin(self.min, np.fmin.reduce(values, axis=0,
+                                                        initial=np.inf))
+            self.max = np.fmax(self.max, np.fmax.reduce(values, axis=0,
+                                                        initial=-np.inf))
+            bins = ((values - self.lo) / self.width).astype(np.intp)
+        np.clip(bins, 0, self.nbins - 1, out=bins)
+        # 分布ごとにビンの番号をずらして1回のbincountで数える
+        # NaNは最後の余分なビンに入れて捨てる
+        bins += np.arange(self.n) * self.nbins
+        bins[np.isnan(values)] = size
+        self.counts += np.bincount(bins.ravel(), minlength=size +
+                                   1)[:size].reshape(self.counts.shape)
+
+    def merge(self, other):
+        """otherの値を足す(ビンが同じスケッチどうし)"""
+        if (self.n, self.lo, self.width, self.nbins) != \
+                (other.n, other.lo, other.width, other.nbins):
+            raise ValueError('Cannot merge sketches with different bins')
+        self.counts += other.counts
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        self.outside += other.outside
+        return self
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def copy(self):
+        new = QuantileSketch.__new__(QuantileSketch)
+        new.__dict__.update({
+            k: v.copy() if isinstance(v, np.ndarray) else v
+            for k, v in self.__dict__.items()
+        })
+        return new
+
+    def quantile(self, percent: float = 25) -> np.ndarray:
+        """分布ごとのpercent[%]点(np.percentileと同じ線形補間)
+        値がない分布はNaN"""
+        if self.outside.any():
+            warnings.warn('{} values outside [{}, {}); quantiles of those '
+                          'columns may exceed the error bound'.format(
+                              int(self.outside.sum()), self.lo, self.hi))
+        count = self.count
+        rank = percent / 100 * np.maximum(count - 1, 0)
+        k = np.floor(rank)
+        # 行ごとのsearchsortedを、行をずらした1本の累積和で
+        offset = np.arange(self.n) * (count.max(initial=0) + 1)
+        cum = (self.counts.cumsum(axis=1) + offset[:, None]).ravel()
+        below = np.searchsorted(cum, k + offset, 'right')
+        above = np.searchsorted(cum, np.minimum(k + 1, count - 1) + offset,
+                                'right')
+        base = np.arange(self.n) * self.nbins
+        center = self.lo + self.width / 2
+        x0 = center + (below - base) * self.width
+        x1 = center + (above - base) * self.width
+        result = np.clip(x0 + (rank - k) * (x1 - x0), self.min, self.max)
+        return np.where(count > 0, result, np.nan)
+
+
+def streaming_noisefloor(chunks,
+                         axis: int = 0,
+                         percent: float = 25,
+                         error: float = 0.05,
+                         lo: float = -200.,
+                         hi: float = 50.):
+    """chunksを1つずつQuantileSketchに数えてノイズフロアを返す
+    dbmw.noisefloor(df, axis, percent)をchunksをつなげたdfに使うのと
+    error以内で同じになる
+
+    args:
+        chunks: DataFrameのイテレータ(csv_reader.iter_rows()など)
+            axis=0: 同じ列の行(周波数)を分けたもの。列ごとのノイズフロア
+            axis=1: 同じ行の列(trace)を分けたもの。行ごとのノイズフロア
+        percent, error, lo, hi: QuantileSketchの引数
+
+    return: ノイズフロア(シリーズ型)
+    """
+    sketch, labels = None, None
+    for chunk in chunks:
+        values = np.asarray(chunk, dtype=float)
+        keys = chunk.columns if axis == 0 else chunk.index
+        if axis == 1:
+            values = values.T
+        if sketch is None:
+            sketch, labels = QuantileSketch(values.shape[1], error, lo,
+                                            hi), keys
+        elif not keys.equals(labels):
+            raise ValueError('Chunks must share the same {}'.format(
+                'columns' if axis == 0 else 'index'))
+        sketch.update(values)
+    if sketch is None:
+        return pd.Series(dtype=float)
+    return pd.Series(sketch.quantile(percent), index=labels)
+
+
+def streaming_describe_SN(chunks,
+                          freq,
+                          width: float = 0.02,
+                          error: float = 0.05,
+                          lo: float = -200.,
+                          hi: float = 50.):
+    """describe_SN(data, freq, width)をdataの行を分けたchunksから1回で計算する
+    ノイズフロアはQuantileSketchの25パーセンタイル(誤差error以内)
+    atfreq, シグナル平均は正確な値
+
+    args:
+        chunks: 同じ列の行(周波数の昇順)を分けたDataFrameのイテレータ
+        freq, width: describe_SN()の引数
+        error, lo, hi: QuantileSketchの引数
+
+    return: describe_SN()と同じ形のDataFrame
+
+    >>> f = np.round(np.arange(149.9, 150.1, 0.01), 2)
+    >>> df = pd.DataFrame({'a': np.arange(len(f)) * 1.,
+    ...                    'b': np.arange(len(f)) * -2.}, index=f)
+    >>> chunks = (df.iloc[i:i + 7] for i in range(0, len(df), 7))
+    >>> sn = streaming_describe_SN(chunks, [149.95, 150.0])
+    >>> sn['SN比'].round(2).tolist()  # describe_SN: [0.25, 18.5, 5.25, 8.5]
+    [0.2, 18.45, 5.2, 8.45]
+    """
+    freqs = np.atleast_1d(np.asarray(freq, dtype=float))
+    n = len(freqs)
+    sketch = columns = atfreq = found = sums = None
+    for chunk in chunks:
+        values = np.asarray(chunk, dtype=float)
+        index = np.asarray(chunk.index, dtype=float)
+        if sketch is None:
+            columns = chunk.columns
+            sketch = QuantileSketch(values.shape[1], error, lo, hi)
+            atfreq = np.full((n, values.shape[1]), np.nan)
+            found = np.zeros(n, dtype=bool)
+            sums = np.zeros((4, n, values.shape[1]))
+        sketch.update(values)
+        pos = np.searchsorted(
+            index, np.concatenate([freqs, freqs - width, freqs + width]))
+        at, start, stop = pos[:n], pos[n:2 * n], pos[2 * n:]
+        last = len(index) - 1
+        stop += (stop <= last) & (index[np.minimum(stop, last)] ==
+                                  freqs + width)
+        hit = (at <= last) & (index[np.minimum(at, last)] == freqs)
+        atfreq[hit] = values[at[hit]]
+        found |= hit
+        sums += _window_sums(values, start, stop)
+    if sketch is None or not found.all():
+        raise KeyError(freqs if found is None else freqs[~found].tolist())
+    return _sn_frame(freq, columns, atfreq, _window_mean(sums),
+                     sketch.quantile(25))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""長時間の監視データ用のtrace保存先
+
+共通の周波数軸と、掃引ごとに追記するnp.memmapと日時で保存する。
+DataFrameに全部読み込まずに、日時の範囲を切り出した
+ゼロコピーのDataFrame(行が周波数、列が日時)を
+describe_SN, noisefloor, Syncfにそのまま渡せる。
+
+ディレクトリの中身:
+    store.json: dtype, 周波数の数
+    freq.npy: 周波数
+    data.bin: 掃引(1行1掃引, shape=(掃引数, 周波数の数))
+    times.bin: 掃引の日時(datetime64[ns]のint64)
+
+usage:
+    `ts = TraceStore.create('monitor', freq=df.index)`
+    `ts.append(df)`  # 行が周波数、列が日時のDataFrameを追記
+    `ts.frame('2020-01-01', '2020-01-07')`  # 日時の範囲のDataFrame
+    `describe_SN(ts.frame('2020-01-01 12:00', '2020-01-01 13:00'), 150)`
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+class TraceStore:
+    """追記専用の掃引データ
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> ts = TraceStore.create(d, freq=[100., 200., 300.])
+    >>> ts.append([[1, 2, 3], [4, 5, 6]], ['2020-01-01', '2020-01-02'])
+    >>> ts.append([7, 8, 9], '2020-01-03')
+    >>> len(ts)
+    3
+    >>> df = ts.frame('2020-01-02', '2020-01-03')
+    >>> df.columns.strftime('%m/%d').tolist()
+    ['01/02', '01/03']
+    >>> df.loc[200.0].tolist()
+    [5.0, 8.0]
+    >>> TraceStore(d).values('2020-01-03').tolist()
+    [[7.0, 8.0, 9.0]]
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, 'store.json')) as f:
+            info = json.load(f)
+        self.dtype = np.dtype(info['dtype'])
+        self.freq = np.load(os.path.join(directory, 'freq.npy'))
+        self._data_path = os.path.join(directory, 'data.bin')
+        self._times_path = os.path.join(directory, 'times.bin')
+        self._n = None
+        self._data = None
+        self._times = None
+
+    @classmethod
+    def create(cls, directory: str, freq, dtype='float64'):
+        """新しいTraceStoreを作る
+        freq: 周波数軸(全掃引で共通)
+        dtype: 保存する値の型(容量を減らすなら'float32')"""
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, 'store.json')):
+            raise FileExistsError(
+                'TraceStore already exists in {}'.format(directory))
+        freq = np.asarray(freq, dtype=float)
+        np.save(os.path.join(directory, 'freq.npy'), freq)
+        for name in ('data.bin', 'times.bin'):
+            open(os.path.join(directory, name), 'wb').close()
+        with open(os.path.join(directory, 'store.json'), 'w') as f:
+            json.dump({'dtype': np.dtype(dtype).str, 'n_freq': len(freq)}, f)
+        return cls(directory)
+
+    @classmethod
+    def from_frame(cls, directory: str, df, dtype='float64'):
+        """行が周波数、列が日時のDataFrameからTraceStoreを作る"""
+        store = cls.create(directory, df.index, dtype)
+        store.append(df)
+        return store
+
+    def __len__(self):
+        return self._refresh()
+
+    def __repr__(self):
+        return 'TraceStore({!r}, sweeps={}, freq={})'.format(
+            self.directory, len(self), len(self.freq))
+
+    def append(self, values, times=None):
+        """掃引を追記する
+        values: 1掃引(shape=(周波数の数,))か複数の掃引(shape=(n, 周波数の数))
+            行が周波数、列が日時のDataFrameならtimesは列名
+        times: 掃引の日時(前の掃引より古い日時は追記できない)
+        """
+        if isinstance(values, pd.DataFrame):
+            if not np.array_equal(np.asarray(values.index, dtype=float),
+                                  self.freq):
+                raise ValueError('Frequency axis does not match the store')
+            times = values.columns if times is None else times
+            values = values.values.T
+        values = np.atleast_2d(np.asarray(values, dtype=self.dtype))
+        times = pd.DatetimeIndex(np.atleast_1d(times)).values.astype(
+            'datetime64[ns]')
+        if values.shape[1] != len(self.freq):
+            raise ValueError('Expected {} points per sweep, got {}'.format(
+                len(self.freq), values.shape[1]))
+        if len(times) != len(values):
+            raise ValueError('{} sweeps but {} times'.format(
+                len(values), len(times)))
+        last = self.times[-1:] if len(self) else times[:0]
+        if np.any(np.diff(np.concatenate([last, times])) <
+                  np.timedelta64(0)):
+            raise ValueError('Sweeps must be appended in time order')
+        # 日時を後に書くので、読む側は日時の数までを有効な掃引とみなす
+        with open(self._data_path, 'ab') as f:
+            f.write(np.ascontiguousarray(values).tobytes())
+        with open(self._times_path, 'ab') as f:
+            f.write(times.view(np.int64).tobytes())
+        self._n = None
+
+    def _refresh(self) -> int:
+        """ファイルの長さが変わっていればメモリマップを作り直す"""
+        n = min(
+            os.path.getsize(self._times_path) // 8,
+            os.path.getsize(self._data_path) //
+            (self.dtype.itemsize * len(self.freq) or 1))
+        if n != self._n:
+            self._n = n
+            if n:
+                self._data = np.memmap(self._data_path, self.dtype, 'r',
+                                       shape=(n, len(self.freq)))
+                self._times = np.memmap(self._times_path, np.int64, 'r',
+                                        shape=(n, )).view('datetime64[ns]')
+            else:
+                self._data = np.zeros((0, len(self.freq)), self.dtype)
+                self._times = np.zeros(0, 'datetime64[ns]')
+        return n
+
+    @property
+    def times(self) -> np.ndarray:
+        """掃引の日時(datetime64[ns], memmap)"""
+        self._refresh()
+        return self._times
+
+    def locate(self, start=None, stop=None) -> slice:
+        """日時start~stop(両端を含む)の掃引の行のslice"""
+        times = self.times
+        i0 = 0 if start is None else np.searchsorted(
+            times, np.datetime64(pd.Timestamp(start), 'ns'), 'left')
+        i1 = len(times) if stop is None else np.searchsorted(
+            times, np.datetime64(pd.Timestamp(stop), 'ns'), 'right')
+        return slice(int(i0), int(i1))
+
+    def values(self, start=None, stop=None) -> np.ndarray:
+        """日時start~stopの掃引(shape=(n, 周波数の数), memmapのview)"""
+        self._refresh()
+        return self._data[self.locate(start, stop)]
+
+    def frame(self, start=None, stop=None) -> pd.DataFrame:
+        """日時start~stopの掃引を、行が周波数、列が日時のDataFrameにする
+        値はコピーせずmemmapを参照する(読み取り専用)"""
+        return self._frame(self.locate(start, stop))
+
+    def iter_frames(self, sweeps: int, start=None, stop=None):
+        """日時start~stopをsweeps掃引ずつのframe()に分けて返すジェネレータ"""
+        rows = self.locate(start, stop)
+        for i in range(rows.start, rows.stop, sweeps):
+            yield self._frame(slice(i, min(i + sweeps, rows.stop)))
+
+    def _frame(self, rows: slice) -> pd.DataFrame:
+        return pd.DataFrame(self._data[rows].T,
+                            index=pd.Index(self.freq, name='Frequency'),
+                            columns=pd.DatetimeIndex(self._times[rows],
+                                                     name='Datetime'),
+                            copy=False)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""ディレクトリを監視して、新しいCSVだけを読んで解析する
+
+ディレクトリ全体をreader_N9010A + describe_SNで読み直す代わりに、
+ポーリングで新しいファイルだけを見つけて1ファイルずつ読み、
+S/N, ノイズフロア(, Syncf)をそのtraceについてだけ計算する。
+ただしポーリングのたびにディレクトリ全体をscandirするので、
+その手間はディレクトリのファイル数に比例する
+(読み終えたファイルは別のディレクトリに移すとよい)。
+読めなかったファイルは警告を出して飛ばし、更新されたら読み直す。
+
+usage:
+    # ジェネレータ
+    for up in watch('monitor', freq=150, interval=10):
+        print(up.name, up.summary['SN比'])
+
+    # コールバックとTraceStoreへの追記
+    w = Watcher('monitor', freq=150, store=TraceStore('store'))
+    w.run(callback=print)
+    w.summary()  # これまでの解析結果(DataFrame)
+"""
+from collections import namedtuple
+import fnmatch
+import os
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from .csv_reader import cached_read_trace
+from .csv_reader import resample
+from .describe_SN import describe_SN
+from .sana import Syncf
+
+Update = namedtuple('Update', 'name time trace meta summary')
+Update.__doc__ = """Watcherが1ファイル読むごとに返す結果
+    name: ファイルのbasename
+    time: ファイルの更新時刻(pd.Timestamp)
+        storeの最後の掃引より古いときは読んだ時刻
+    trace: index=周波数のpd.Series
+    meta: csv_reader.read_trace()のメタデータ
+    summary: 解析結果(pd.Series)
+"""
+
+
+class Watcher:
+    """directoryの新しいファイルを読んで解析する
+
+    args:
+        directory: 監視するディレクトリ
+        freq: describe_SNの周波数(Noneならノイズフロアだけ)
+        pattern: 読むファイル名のパターン
+        interval: ポーリング間隔[s]
+        settle: 更新からsettle[s]たっていないファイルは書き込み中とみなして後で読む
+        store: 指定するとtraceをTraceStoreに追記する
+            周波数が違うtraceはstoreの周波数に補間する
+        keep: Trueならtraceをself.tracesに残す
+        syncf: TrueならSyncfのf1, f2, f0, fmax, BW, Q, aも計算する
+            解析に失敗した掃引もstoreには追記し、その列はNaNにする
+        engine, cache: csv_reader.cached_read_trace()の引数
+    """
+
+    def __init__(self,
+                 directory: str,
+                 freq: float = None,
+                 pattern: str = '*.csv',
+                 interval: float = 5.0,
+                 settle: float = 1.0,
+                 store=None,
+                 keep: bool = False,
+                 syncf: bool = False,
+                 engine: str = 'c',
+                 cache=False):
+        self.directory = directory
+        self.freq = freq
+        self.pattern = pattern
+        self.interval = interval
+        self.settle = settle
+        self.store = store
+        self.keep = keep
+        self.syncf = syncf
+        self.engine = engine
+        self.cache = cache
+        self.seen = set()
+        # 読めなかったファイル: パス -> 更新時刻(更新されたら読み直す)
+        self.failed = {}
+        self.traces = {}
+        self._summaries = []
+
+    def new_files(self) -> list:
+        """まだ読んでいない書き込み済みのファイル(更新時刻, 名前の順)"""
+        now = time.time()
+        found = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.path in self.seen or not entry.is_file() or \
+                        not fnmatch.fnmatch(entry.name, self.pattern):
+                    continue
+                mtime = entry.stat().st_mtime
+                if self.failed.get(entry.path) == mtime:
+                    continue
+                if now - mtime >= self.settle:
+                    found.append((mtime, entry.name, entry.path))
+        return sorted(found)
+
+    def poll(self) -> list:
+        """新しいファイルを1回だけ探して読み、Updateのリストを返す
+        読めなかったファイルは警告を出して飛ばす"""
+        updates = []
+        for mtime, _, path in self.new_files():
+            try:
+                updates.append(self.ingest(path, mtime))
+            except Exception as err:
+                # 1ファイルの失敗で監視を止めない
+                warnings.warn('Watcher: skipped {}: {}'.format(path, err))
+                self.failed[path] = mtime
+        return updates
+
+    def ingest(self, path: str, mtime: float = None) -> Update:
+        """1ファイルを読んでstoreに追記してから解析する
+        storeの最後の掃引より更新時刻が古いファイル(cp -pやrsyncでコピーしたもの)
+        は、読んだ時刻で追記する"""
+        mtime = os.path.getmtime(path) if mtime is None else mtime
+        stamp = pd.Timestamp(mtime, unit='s')
+        name = os.path.splitext(os.path.basename(path))[0]
+        trace, meta = cached_read_trace(path, self.engine, self.cache)
+        trace = trace.rename(name)
+        if self.store is not None:
+            if len(self.store) and stamp < self.store.times[-1]:
+                last = pd.Timestamp(self.store.times[-1])
+                warnings.warn('Watcher: {} is older than the last sweep in '
+                              'the store; stored at the ingest time'.format(
+                                  path))
+                stamp = max(pd.Timestamp(time.time(), unit='s'), last)
+            values = trace.values
+            if len(trace) != len(self.store.freq) or \
+                    (trace.index.values != self.store.freq).any():
+                values = resample([trace], self.store.freq)[1][:, 0]
+            self.store.append(values, stamp)
+        # 掃引は保存できたので、解析に失敗しても読み直さない
+        self.seen.add(path)
+        self.failed.pop(path, None)
+        if self.keep:
+            self.traces[name] = trace
+        summary = self.analyze(trace)
+        summary.name = stamp
+        self._summaries.append((name, summary))
+        return Update(name, stamp, trace, meta, summary)
+
+    def analyze(self, trace) -> pd.Series:
+        """1本のtraceの解析結果
+        describe_SNの列(freqを指定したとき)かノイズフロア、
+        syncf=TrueならSyncf.describe()も加える
+        freqがリストなら周波数ごとの列を'シグナル平均(150.0kHz)'のように並べる
+        describe_SNやSyncfが失敗したら、警告を出してその列をNaNにする"""
+        if self.freq is None:
+            summary = pd.Series({'ノイズフロア': trace.quantile(0.25)})
+        else:
+            summary = _try(self._describe_SN, trace, self._sn_keys(),
+                           trace.name)
+        if self.syncf:
+            summary = pd.concat([
+                summary,
+                _try(lambda t: Syncf(t).describe(), trace, _SYNCF_KEYS,
+                     trace.name)
+            ])
+        return summary
+
+    def _describe_SN(self, trace) -> pd.Series:
+        """describe_SNの結果を1行にする"""
+        sn = describe_SN(trace.to_frame(), self.freq)
+        if np.ndim(self.freq) == 0:
+            return sn.iloc[0]
+        sn = sn.xs(trace.name, level=1)
+        return pd.Series(dict(zip(self._sn_keys(), _flatten(sn))))
+
+    def _sn_keys(self) -> list:
+        """analyze()のdescribe_SNの列名"""
+        if np.ndim(self.freq) == 0:
+            return ['{}kHz'.format(self.freq), 'シグナル平均', 'ノイズフロア', 'SN比']
+        keys = ['ノイズフロア']
+        for f in np.asarray(self.freq, dtype=float):
+            keys += ['{}kHz'.format(f), 'シグナル平均({}kHz)'.format(f),
+                     'SN比({}kHz)'.format(f)]
+        return keys
+
+    def summary(self) -> pd.DataFrame:
+        """これまでに読んだファイルの解析結果(行がファイル)"""
+        if not self._summaries:
+            return pd.DataFrame()
+        df = pd.DataFrame([s for _, s in self._summaries])
+        df.insert(0, 'name', [n for n, _ in self._summaries])
+        df.index.name = 'time'
+        return df
+
+    def stream(self, timeout: float = None):
+        """新しいファイルを読むたびにUpdateを返すジェネレータ
+        timeout[s]の間新しいファイルがなければ止まる(Noneなら止まらない)"""
+        idle = 0.0
+        while True:
+            updates = self.poll()
+            yield from updates
+            if updates:
+                idle = 0.0
+            elif timeout is not None and idle >= timeout:
+                return
+            time.sleep(self.interval)
+            idle += self.interval
+
+    def run(self, callback, timeout: float = None):
+        """新しいファイルを読むたびにcallback(update)を呼ぶ"""
+        for update in self.stream(timeout):
+            callback(update)
+
+
+_SYNCF_KEYS = ['f1', 'f2', 'f0', 'fmax', 'BW', 'Q', 'a']
+
+
+def _flatten(sn) -> list:
+    """describe_SN(freqがリスト)の1列分を_sn_keys()の順に並べる"""
+    values = [sn['ノイズフロア'].iloc[0]]
+    for _, row in sn.iterrows():
+        values += [row['atfreq'], row['シグナル平均'], row['SN比']]
+    return values
+
+
+def _try(func, trace, keys, name) -> pd.Series:
+    """func(trace)が失敗したら警告を出して、keysがNaNのSeriesを返す"""
+    try:
+        return func(trace)
+    except Exception as err:
+        warnings.warn('Watcher: analysis of {} failed: {}'.format(name, err))
+        return pd.Series(np.nan, index=keys)
+
+
+def watch(directory: str, freq: float = None, timeout: float = None,
+          **kwargs):
+    """`Watcher(directory, freq, **kwargs).stream(timeout)`"""
+    return Watcher(directory, freq, **kwargs).stream(timeout)